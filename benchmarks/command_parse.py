@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# Measures the cost of turning a command message into arguments, compared to
+# calling shlex.split on every message. Run from the repository root:
+#
+#   python3 benchmarks/command_parse.py
+
+import os
+import sys
+import time
+import shlex
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from types import SimpleNamespace
+from commands.basic import parse_command
+
+messages = [
+    '/weather toronto,ca',
+    '/xkcd 353',
+    '/rss news https://example.com/feed.xml 15m',
+    '/popular "CN Tower"',
+    '/moviesearch "the big lebowski"',
+    '/math 2 * (3 + 4)',
+]
+
+def timed(func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        for text in messages:
+            func(text)
+    return (time.perf_counter() - start) / (count * len(messages)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", default = 20000, type = int)
+    args = parser.parse_args()
+    def fresh(text):
+        return parse_command(SimpleNamespace(message = SimpleNamespace(text = text)))
+    update = SimpleNamespace(message = SimpleNamespace(text = messages[0]))
+    parse_command(update)
+    print("shlex.split:         {:.2f} us/message".format(timed(shlex.split, args.count)))
+    print("parse_command:       {:.2f} us/message".format(timed(fresh, args.count)))
+    print("parse_command (hit): {:.2f} us/message".format(timed(lambda text: parse_command(update), args.count)))
+
+if __name__ == "__main__":
+    main()
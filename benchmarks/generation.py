@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Measures sentence generation latency for /sonnetgen and /markov with fixed
+# seeds, so runs are repeatable. Run from the repository root:
+#
+#   python3 benchmarks/generation.py
+#   python3 benchmarks/generation.py --runs 1000 --sentences 20000
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from commands.sonnetgen import SonnetGen, sonnet_model
+from commands.markovchain import MappedText, Generator
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return [samples[min(len(samples) - 1, int(q * len(samples)))] * 1000 for q in (0.5, 0.99, 1.0)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", default = 300, type = int,
+                        help = "generations timed per case")
+    parser.add_argument("--sentences", default = 5000, type = int,
+                        help = "size of the synthetic chat model")
+    args = parser.parse_args()
+    sonnets = SonnetGen(logging)
+    sonnet_model()
+    rng = random.Random(1234)
+    vocab = ['w{}'.format(i) for i in range(2000)]
+    chat = MappedText(state_size = 3)
+    for _ in range(args.sentences):
+        chat.add_text(' '.join(rng.choice(vocab) for _ in range(rng.randint(4, 14))) + '.')
+    path = os.path.join(tempfile.mkdtemp(), 'chat.markov')
+    chat.save(path)
+    chat = Generator(MappedText.load(path))
+    cases = (
+        ("sonnetgen", lambda seed: sonnets.make_sonnet(seed)),
+        ("markov", lambda seed: chat.make(seed = seed)),
+    )
+    print("{:>10} {:>9} {:>9} {:>9}".format("case", "p50 ms", "p99 ms", "max ms"))
+    for name, func in cases:
+        samples = []
+        for seed in range(args.runs):
+            start = time.perf_counter()
+            func(seed)
+            samples.append(time.perf_counter() - start)
+        print("{:>10} {:>9.2f} {:>9.2f} {:>9.2f}".format(name, *percentiles(samples)))
+
+if __name__ == "__main__":
+    main()
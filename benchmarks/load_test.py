@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# Runs kadebot.main offline against a fake Telegram Bot API and mocked
+# upstream services, replays synthetic chat traffic, and reports how many
+# updates a second it handles, reply latency and memory over time. Run from
+# the repository root:
+#
+#   python3 benchmarks/load_test.py
+#   python3 benchmarks/load_test.py --rate 300 --duration 60 --upstream-latency 0.05
+#   python3 benchmarks/load_test.py --mix "8ball:1,markov:1" --text-ratio 0.8 --json baseline.json
+#
+# Commands are sent from --chats group chats and replies are matched to them
+# in order, so latency is measured from the moment an update is available to
+# getUpdates until the first reply arrives. --rss-chats private chats are
+# subscribed to one feed that gets a new item every --feed-period seconds,
+# and each item's fan-out time is from publication to its last delivery.
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import datetime
+import logging
+import argparse
+import tempfile
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kadebot
+from commands import CommandBase
+from commands.rss import FeedStore
+from commands.todayfact import TodayFact
+from commands.metrics import metrics
+
+TOKEN = '123456:LOADTEST'
+FEED_URL = 'http://feeds.example/load.xml'
+MODULES = ('Dog', 'EightBall', 'Markov', 'MathEval', 'RSS', 'SonnetGen', 'Ted', 'TodayFact', 'XKCD')
+
+# Command text and the number of messages each one replies with.
+COMMANDS = {
+    '8ball': ('/8ball will this be fast?', 1),
+    'math': ('/math 2^10 + 3*7', 1),
+    'dog': ('/dog', 1),
+    'xkcd': ('/xkcd 353', 2),
+    'xkcdr': ('/xkcdr', 2),
+    'today': ('/today', 1),
+    'ted': ('/tedr', 1),
+    'markov': ('/markov', 1),
+    'sonnetgen': ('/sonnetgen', 1),
+}
+WORDS = ('the quick brown fox jumps over lazy dogs while a small cat watches from '
+         'the warm window and nobody in this chat can agree on lunch today').split()
+
+def percentile(samples, q):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def rss_mib():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Answers the Bot API methods the bot uses. getUpdates long-polls the queue
+# filled by the traffic generator, and every send is reported to the tracker.
+class FakeTelegram:
+    def __init__(self, tracker, latency):
+        self.tracker = tracker
+        self.latency = latency
+        self.cond = threading.Condition()
+        self.updates = deque()
+        self.next_id = 1
+        self.message_id = 0
+        self.server = None
+    def push(self, message):
+        with self.cond:
+            self.message_id += 1
+            message['message_id'] = self.message_id
+            self.updates.append({'update_id': self.next_id, 'message': message})
+            self.next_id += 1
+            self.cond.notify_all()
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            return [self.updates[i] for i in range(min(100, len(self.updates)))]
+    def sent(self, method, params):
+        time.sleep(self.latency)
+        chat_id = int(params['chat_id'])
+        self.tracker.reply(chat_id, params.get('text') or params.get('caption') or '')
+        with self.cond:
+            self.message_id += 1
+            message_id = self.message_id
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'}}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'photo{}'.format(message_id), 'file_unique_id': str(message_id),
+                                 'width': 1, 'height': 1}]
+        elif 'text' in params:
+            message['text'] = params['text']
+        return message
+    def call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'kadebot', 'username': 'kadebot'}
+        if method == 'getMyCommands':
+            return []
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method.startswith('send'):
+            return self.sent(method, params)
+        return True
+    def start(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.do_POST()
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                if 'json' in self.headers.get('Content-Type', ''):
+                    params = json.loads(body or '{}')
+                else:
+                    params = dict(parse_qsl(body or urlsplit(self.path).query))
+                method = urlsplit(self.path).path.rsplit('/', 1)[-1]
+                out = json.dumps({'ok': True, 'result': fake.call(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return 'http://127.0.0.1:{}/bot'.format(self.server.server_address[1])
+
+# Mounted on CommandBase.http's session in place of the real network.
+class MockUpstream(BaseAdapter):
+    def __init__(self, latency, feed_period):
+        super().__init__()
+        self.latency = latency
+        self.feed_period = feed_period
+        self.started = time.time()
+        self.counter = 0
+    def feed(self):
+        newest = int((time.time() - self.started) // self.feed_period)
+        items = ''.join('<item><title>item {0}</title><link>http://feeds.example/{0}</link>'
+                        '<guid>item-{0}</guid></item>'.format(n) for n in range(newest, max(-1, newest - 5), -1))
+        return 'application/rss+xml', '<?xml version="1.0"?><rss version="2.0"><channel>' \
+            '<title>load</title>{}</channel></rss>'.format(items)
+    def route(self, host, path):
+        self.counter += 1
+        if host == 'dog.ceo' and path.endswith('/random'):
+            return 'application/json', json.dumps({'status': 'success', 'message':
+                'https://images.dog.ceo/breeds/hound-afghan/n{}.jpg'.format(self.counter % 50)})
+        if host == 'dog.ceo':
+            return 'application/json', json.dumps({'status': 'success', 'message': {'hound': ['afghan'], 'pug': []}})
+        if host == 'xkcd.com':
+            num = path.strip('/').split('/')[0]
+            return 'application/json', json.dumps({'num': int(num), 'title': 'Comic {}'.format(num), 'alt': 'alt text',
+                'img': 'https://imgs.xkcd.com/comics/{}.png'.format(num), 'year': '2008', 'month': '1', 'day': '1'})
+        if host == 'numbersapi.com':
+            month, day = path.strip('/').split('/')[:2]
+            return 'text/plain', '{} is the day in {} that event {} happened.'.format(
+                TodayFact.day_string(None, datetime.date(2000, int(month), int(day))), 1500 + self.counter % 500, self.counter)
+        if host == 'ted.kaderobertson.pw':
+            return 'application/json', json.dumps({'url': 'https://ted.example/{}'.format(self.counter % 100),
+                'name': 'Talk', 'description': 'A talk.', 'talks': [{'duration': 600}],
+                'recorded_date': 1262304000, 'event': 'TED2010'})
+        if host == 'feeds.example':
+            return self.feed()
+        return None
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        parts = urlsplit(request.url)
+        resp = requests.Response()
+        resp.request = request
+        resp.url = request.url
+        if parts.netloc == 'c.xkcd.com':
+            resp.url = 'https://xkcd.com/{}/'.format(1 + self.counter % 2000)
+        routed = self.route(parts.netloc, parts.path)
+        if routed is None and parts.netloc != 'c.xkcd.com':
+            resp.status_code = 404
+            resp._content = b''
+        else:
+            content_type, body = routed or ('text/html', '')
+            resp.status_code = 200
+            resp._content = body.encode('utf-8') if request.method != 'HEAD' else b''
+            resp.headers = CaseInsensitiveDict({'Content-Type': content_type})
+        resp.encoding = 'utf-8'
+        return resp
+    def close(self):
+        pass
+
+# Matches replies to the commands that caused them, chat by chat, and keeps
+# per-interval samples for the report.
+class Tracker:
+    feed_item = re.compile(r'item (\d+)')
+    def __init__(self, feed_period, rss_chats):
+        self.lock = threading.Lock()
+        self.feed_period = feed_period
+        self.rss_chats = rss_chats
+        self.started = time.time()
+        self.waiting = dict()
+        self.latencies = []
+        self.window = []
+        self.replies = 0
+        self.broadcasts = 0
+        self.items = dict()
+    def command(self, chat_id, replies):
+        with self.lock:
+            self.waiting.setdefault(chat_id, deque()).append([time.perf_counter(), replies, False])
+    def reply(self, chat_id, text):
+        now = time.perf_counter()
+        with self.lock:
+            if chat_id > 0:
+                self.broadcasts += 1
+                for n in set(self.feed_item.findall(text)):
+                    self.items.setdefault(int(n), []).append(time.time())
+                return
+            self.replies += 1
+            queue = self.waiting.get(chat_id)
+            if not queue:
+                return
+            entry = queue[0]
+            if not entry[2]:
+                entry[2] = True
+                self.latencies.append(now - entry[0])
+                self.window.append(now - entry[0])
+            entry[1] -= 1
+            if entry[1] <= 0:
+                queue.popleft()
+    def take_window(self):
+        with self.lock:
+            window, self.window = self.window, []
+            return window
+    def unanswered(self):
+        with self.lock:
+            return sum(1 for q in self.waiting.values() for entry in q if not entry[2])
+    def fan_outs(self):
+        out = []
+        with self.lock:
+            for n, stamps in self.items.items():
+                if n > 0 and len(stamps) >= self.rss_chats:
+                    out.append(max(stamps) - (self.started + n * self.feed_period))
+        return out
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition(':')
+        if name not in COMMANDS:
+            raise SystemExit("Unknown command in --mix: {}".format(name))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+def write_config(folder, base_url, args):
+    conf = {
+        'base': {
+            'api_key': TOKEN,
+            'base_url': base_url,
+            'admins': [1],
+            'disabled': [],
+            'disabled_monitors': [],
+            'disabled_schedules': [],
+            'disabled_modules': [clsname for clsname, _, _, _ in kadebot._commands.manifest if clsname not in MODULES],
+            'file_id_cache': {'path': os.path.join(folder, 'file_ids.json')},
+            'workers': {'commands': args.command_workers, 'monitors': args.monitor_workers},
+            'checkpoint_interval': 30,
+        },
+        'command.markov': {'folder': os.path.join(folder, 'markov')},
+        'command.rss': {'data_dir': os.path.join(folder, 'rss'), 'poll_tick': 1},
+        'command.todayfact': {'datfile': os.path.join(folder, 'today.dat')},
+        'command.ted': {'datfile': os.path.join(folder, 'ted.dat')},
+        'command.dog': {'datfile': os.path.join(folder, 'breeds.json')},
+        'command.sonnetgen': {},
+    }
+    if not args.telegram_limits:
+        conf['base']['send_queue'] = {'global_rate': 100000, 'private_rate': 100000, 'private_burst': 100000,
+                                      'group_rate': 100000, 'group_burst': 100000, 'workers': 16}
+    os.makedirs(os.path.join(folder, 'rss'))
+    store = FeedStore(os.path.join(folder, 'rss', 'feeds.sqlite3'))
+    for n in range(args.rss_chats):
+        store.add(n + 1, 'load', FEED_URL, 1, 'item-0')
+    store.close()
+    path = os.path.join(folder, 'config.yaml')
+    with open(path, 'w') as f:
+        kadebot.yaml.dump(conf, f)
+    return path
+
+def traffic(fake, tracker, args, mix, stop):
+    rng = random.Random(args.seed)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    start = time.perf_counter()
+    n = 0
+    while not stop.is_set():
+        delay = start + n / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        chat_id = -1000 - rng.randrange(args.chats)
+        user = rng.randrange(1, args.users + 1)
+        message = {'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'group', 'title': 'load'},
+                   'from': {'id': user, 'is_bot': False, 'first_name': 'user{}'.format(user)}}
+        if rng.random() < args.text_ratio:
+            message['text'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))) + '.'
+        else:
+            text, replies = COMMANDS[rng.choices(names, weights)[0]]
+            message['text'] = text
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            tracker.command(chat_id, replies)
+        fake.push(message)
+        n += 1
+
+def handled(names):
+    with metrics.lock:
+        return sum(n for name, n in metrics.calls.items() if name in names)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", default = 30, type = float, help = "seconds of traffic")
+    parser.add_argument("--rate", default = 100, type = float, help = "updates sent per second")
+    parser.add_argument("--mix", default = "8ball:4,math:3,dog:2,xkcd:1,today:1,ted:1,markov:2,sonnetgen:1",
+                        help = "command:weight pairs to pick commands from")
+    parser.add_argument("--text-ratio", default = 0.5, type = float,
+                        help = "share of updates that are plain text for the monitors")
+    parser.add_argument("--chats", default = 50, type = int, help = "group chats sending updates")
+    parser.add_argument("--users", default = 200, type = int, help = "users sending updates")
+    parser.add_argument("--rss-chats", default = 200, type = int, help = "chats subscribed to the test feed")
+    parser.add_argument("--feed-period", default = 10, type = float, help = "seconds between new feed items")
+    parser.add_argument("--upstream-latency", default = 0.02, type = float, help = "seconds per mocked upstream call")
+    parser.add_argument("--telegram-latency", default = 0.01, type = float, help = "seconds per fake Bot API send")
+    parser.add_argument("--telegram-limits", action = "store_true",
+                        help = "keep the send queue's real Telegram rate limits")
+    parser.add_argument("--command-workers", default = 8, type = int)
+    parser.add_argument("--monitor-workers", default = 2, type = int)
+    parser.add_argument("--interval", default = 5, type = float, help = "seconds between report lines")
+    parser.add_argument("--seed", default = 1234, type = int)
+    parser.add_argument("--json", help = "also write the summary to this file")
+    parser.add_argument("--verbose", action = "store_true", help = "show the bot's own log output")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    mix = parse_mix(args.mix)
+    tracker = Tracker(args.feed_period, args.rss_chats)
+    fake = FakeTelegram(tracker, args.telegram_latency)
+    base_url = fake.start()
+    folder = tempfile.mkdtemp(prefix = 'kadebot-load-')
+    kadebot.load_config(write_config(folder, base_url, args))
+    upstream = MockUpstream(args.upstream_latency, args.feed_period)
+    CommandBase.http.sess.mount('http://', upstream)
+    CommandBase.http.sess.mount('https://', upstream)
+    memory_start = rss_mib()
+    kadebot.main()
+    names = set(COMMANDS[name][0].split()[0][1:] for name, _ in mix) | {'markov_monitor'}
+    stop = threading.Event()
+    sender = threading.Thread(target = traffic, args = (fake, tracker, args, mix, stop), daemon = True)
+    start = time.perf_counter()
+    sender.start()
+    print("{:>7} {:>10} {:>9} {:>9} {:>9} {:>10} {:>9}".format(
+        "t (s)", "updates/s", "p50 ms", "p99 ms", "replies", "broadcasts", "RSS MiB"))
+    timeline = []
+    last_handled, last_time = 0, start
+    while True:
+        time.sleep(args.interval)
+        now = time.perf_counter()
+        if now - start >= args.duration:
+            stop.set()
+        total = handled(names)
+        window = tracker.take_window()
+        row = dict(t = now - start, rate = (total - last_handled) / (now - last_time),
+                   p50 = percentile(window, 0.5) * 1000, p99 = percentile(window, 0.99) * 1000,
+                   replies = tracker.replies, broadcasts = tracker.broadcasts, memory = rss_mib())
+        timeline.append(row)
+        print("{t:>7.1f} {rate:>10.1f} {p50:>9.1f} {p99:>9.1f} {replies:>9} {broadcasts:>10} {memory:>9.1f}".format(**row))
+        last_handled, last_time = total, now
+        if stop.is_set() and (tracker.unanswered() == 0 or now - start > args.duration + 30):
+            break
+    elapsed = time.perf_counter() - start
+    fan_outs = tracker.fan_outs()
+    summary = dict(
+        updates = handled(names),
+        updates_per_second = handled(names) / elapsed,
+        p50_ms = percentile(tracker.latencies, 0.5) * 1000,
+        p99_ms = percentile(tracker.latencies, 0.99) * 1000,
+        unanswered = tracker.unanswered(),
+        fan_outs = len(fan_outs),
+        fan_out_p50_s = percentile(fan_outs, 0.5),
+        fan_out_max_s = max(fan_outs) if fan_outs else float('nan'),
+        memory_start_mib = memory_start,
+        memory_peak_mib = max(row['memory'] for row in timeline),
+        send_queue = dict(kadebot.outbox.stats),
+        timeline = timeline,
+        args = vars(args),
+    )
+    print("handled {updates} updates ({updates_per_second:.1f}/s), reply p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms, "
+          "{unanswered} unanswered".format(**summary))
+    print("RSS: {fan_outs} items fanned out to {} chats, p50 {fan_out_p50_s:.2f}s, max {fan_out_max_s:.2f}s".format(
+        args.rss_chats, **summary))
+    print("memory: {memory_start_mib:.1f} MiB before start, {memory_peak_mib:.1f} MiB peak".format(**summary))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent = 2)
+    sys.stdout.flush()
+    # The bot's polling and job threads don't stop on their own.
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
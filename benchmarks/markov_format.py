@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Compares markovify JSON models with compact .markov files: size on disk,
+# load time, memory held after loading, and make_sentence speed. Run from the
+# repository root:
+#
+#   python3 benchmarks/markov_format.py
+#   python3 benchmarks/markov_format.py --sizes 10000 100000
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markovify
+from commands.markovchain import IncrementalText, MappedText, convert_json
+
+def make_messages(rng, vocab, count):
+    for _ in range(count):
+        words = [rng.choice(vocab) for _ in range(rng.randint(4, 14))]
+        yield ' '.join(words).capitalize() + '.'
+
+def measure_load(load):
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = load()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return model, elapsed, current
+
+def measure_sentences(model, count):
+    random.seed(1)
+    start = time.perf_counter()
+    for _ in range(count):
+        model.make_sentence(tries = 1)
+    return (time.perf_counter() - start) / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs = "+", default = [1000, 10000, 100000], type = int,
+                        help = "model sizes to measure, in sentences")
+    parser.add_argument("--sentences", default = 200, type = int,
+                        help = "make_sentence calls timed per model")
+    args = parser.parse_args()
+    rng = random.Random(1234)
+    # A Zipf-like vocabulary, so the chain has a few busy states like real chat.
+    vocab = ['w{}'.format(i) for i in range(5000) for _ in range(max(1, 50 // (i + 1)))]
+    folder = tempfile.mkdtemp()
+    print("{:>9} {:>7} {:>9} {:>9} {:>9} {:>11}".format(
+        "sentences", "format", "disk KiB", "load ms", "mem KiB", "sentence us"))
+    for size in args.sizes:
+        text = IncrementalText(' '.join(make_messages(rng, vocab, size)), state_size = 3)
+        jpath = os.path.join(folder, '{}.json'.format(size))
+        mpath = os.path.join(folder, '{}.markov'.format(size))
+        with open(jpath, 'w') as f:
+            f.write(text.to_json())
+        del text
+        convert_json(jpath, mpath)
+        def load_json():
+            with open(jpath, 'r') as f:
+                return markovify.Text.from_dict(json.load(f))
+        for name, path, load in (("json", jpath, load_json),
+                                 ("compact", mpath, lambda: MappedText.load(mpath))):
+            model, elapsed, memory = measure_load(load)
+            per_sentence = measure_sentences(model, args.sentences)
+            print("{:>9} {:>7} {:>9.0f} {:>9.1f} {:>9.0f} {:>11.1f}".format(
+                size, name, os.path.getsize(path) / 1024, elapsed * 1000, memory / 1024, per_sentence))
+            del model
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Measures the per-message cost of feeding chat messages into a Markov model
+# as the model grows. Run from the repository root:
+#
+#   python3 benchmarks/markov_ingest.py
+#   python3 benchmarks/markov_ingest.py --max 100000 --combine
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markovify
+from commands.markovchain import IncrementalText
+
+def make_messages(rng, vocab, count):
+    for _ in range(count):
+        words = [rng.choice(vocab) for _ in range(rng.randint(4, 14))]
+        yield ' '.join(words).capitalize() + '.'
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max", default = 1000000, type = int,
+                        help = "largest model size to measure, in sentences")
+    parser.add_argument("--sample", default = 1000, type = int,
+                        help = "messages timed at each checkpoint")
+    parser.add_argument("--combine", action = "store_true",
+                        help = "also time markovify.combine (only up to 10k sentences)")
+    args = parser.parse_args()
+    rng = random.Random(1234)
+    vocab = ['w{}'.format(i) for i in range(20000)]
+    checkpoints = [n for n in (1000, 10000, 100000, 1000000) if n <= args.max]
+
+    model = IncrementalText(next(make_messages(rng, vocab, 1)), state_size = 3)
+    size = 1
+    print("{:>10}  {:>14}  {:>14}".format("sentences", "add_text us", "combine us"))
+    for target in checkpoints:
+        for msg in make_messages(rng, vocab, target - size):
+            model.add_text(msg)
+        size = target
+        sample = list(make_messages(rng, vocab, args.sample))
+        start = time.perf_counter()
+        for msg in sample:
+            model.add_text(msg)
+        incr = (time.perf_counter() - start) / len(sample) * 1e6
+        size += len(sample)
+        comb = ''
+        if args.combine and target <= 10000:
+            base = markovify.Text.from_dict(model.to_dict())
+            few = sample[:20]
+            start = time.perf_counter()
+            for msg in few:
+                base = markovify.combine(models = [base, markovify.Text(msg, state_size = 3)])
+            comb = '{:.1f}'.format((time.perf_counter() - start) / len(few) * 1e6)
+        print("{:>10}  {:>14.1f}  {:>14}".format(target, incr, comb))
+    assert model.make_sentence(tries = 100, test_output = False) is not None
+
+if __name__ == "__main__":
+    main()
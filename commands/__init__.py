@@ -1,24 +1,155 @@
+import os
+import sys
+import time
+import threading
+import importlib
 from .basic import CommandBase, CommandInfo, CommandType
-from .cat import Cat
-from .dog import Dog
-from .eightball import EightBall
-from .google import Google
-from .grt import GRT
-from .markov import Markov
-from .matheval import MathEval
-from .movie import Movie
-from .populartimes import PopularTimes
-from .randomaww import RandomAww
-from .rss import RSS
-from .sonnetgen import SonnetGen
-from .ted import Ted
-from .todayfact import TodayFact
-from .translate import Translate
-from .urbandict import UrbanDictionary
-from .weather import Weather
-from .wikipedia import Wikipedia
-from .wolfram import Wolfram
-from .xkcd import XKCD
+
+# Plugin manifest: class name, module, config section name, and the commands,
+# monitors and schedules the plugin registers as (name, help, type, alias).
+# Plugins are only imported when one of these is first used, so keep this in
+# sync with each plugin's to_register list.
+_D, _M, _S = CommandType.Default, CommandType.Monitor, CommandType.Schedule
+manifest = [
+    ('Cat', 'cat', 'cat', [
+        ('cat', 'Displays a random cat image.', _D, None)]),
+    ('Dog', 'dog', 'dog', [
+        ('dog', 'Displays a random dog image.', _D, None),
+        ('dogsearch', 'Search for dog breeds.', _D, None),
+        ('dogbreeds', 'Get list of dog breeds.', _S, None)]),
+    ('EightBall', 'eightball', 'eightball', [
+        ('8ball', 'Shake an 8-ball.', _D, None)]),
+    ('Google', 'google', 'google', [
+        ('google', 'Send a Google search link.', _D, 'g'),
+        ('gimage', 'Returns the first Google Image result for a query', _D, 'gi')]),
+    ('GRT', 'grt', 'grt', [
+        ('grt', 'Get bus times for a stop and bus number', _D, None)]),
+    ('Markov', 'markov', 'markov', [
+        ('markov', 'Emulate yourself talking.', _D, None),
+        ('markov_monitor', 'Model users.', _M, None)]),
+    ('MathEval', 'matheval', 'math', [
+        ('math', 'Evaluate a simple math expression', _D, None)]),
+    ('Movie', 'movie', 'movie', [
+        ('movie', 'Displays movie information.', _D, None),
+        ('moviesearch', 'Searches for a movie.', _D, None)]),
+    ('PopularTimes', 'populartimes', 'populartimes', [
+        ('popular', 'See busy times for a place.', _D, None)]),
+    ('RandomAww', 'randomaww', 'randomaww', [
+        ('randomaww', 'Displays a random image from /r/aww.', _D, None)]),
+    ('RSS', 'rss', 'rss', [
+        ('rss', 'Schedule RSS updates.', _D, None),
+        ('rssfeeds', 'List feeds for this chat.', _D, None),
+        ('rssdel', 'List feeds for this chat.', _D, None),
+        ('check_rss', 'Check feeds.', _S, None)]),
+    ('SonnetGen', 'sonnetgen', 'sonnetgen', [
+        ('sonnetgen', 'Generate a brand-new Shakespeare sonnet.', _D, None),
+        ('sonnet_pool', 'Pre-generate sonnets.', _S, None)]),
+    ('Ted', 'ted', 'ted', [
+        ('ted', 'Displays information for a specific TED Talk.', _D, None),
+        ('tedr', 'Displays information for a random TED Talk.', _D, None),
+        ('tedadd', 'Schedule a daily random TED Talk.', _D, None),
+        ('teddel', 'Remove an existing schedule.', _D, None),
+        ('ted_random', 'Show scheduled daily TED Talks.', _S, None)]),
+    ('TodayFact', 'todayfact', 'todayfact', [
+        ('today', 'See facts about today.', _D, None),
+        ('todayreg', 'Schedule daily facts for this chat.', _D, None),
+        ('todaydel', 'Remove scheduled daily facts for this chat.', _D, None),
+        ('fact_today', 'Show scheduled daily facts', _S, None)]),
+    ('Translate', 'translate', 'translate', [
+        ('translate', 'Translate text to English.', _D, 't')]),
+    ('UrbanDictionary', 'urbandict', 'urbandictionary', [
+        ('udrandom', 'See a random UrbanDictionary definition.', _D, None)]),
+    ('Weather', 'weather', 'weather', [
+        ('weather', "Get a location's weather.", _D, 'w')]),
+    ('Wikipedia', 'wikipedia', 'wikipedia', [
+        ('wiki', 'Displays a Wikipedia summary.', _D, None),
+        ('wikisearch', 'Searches for a Wikipedia article.', _D, None),
+        ('wikirandom', 'Displays a random Wikipedia summary.', _D, None)]),
+    ('Wolfram', 'wolfram', 'wolfram', [
+        ('wolfram', 'Ask Wolfram Alpha a question.', _D, None)]),
+    ('XKCD', 'xkcd', 'xkcd', [
+        ('xkcd', 'View an XKCD comic.', _D, None),
+        ('xkcdr', 'View a random XKCD comic.', _D, None)]),
+]
+
+class Plugin:
+    def __init__(self, clsname, module, safename, entries, logger):
+        self.clsname = clsname
+        self.module = module
+        self.safename = safename
+        self.logger = logger
+        self.confdict = None
+        self.configured = False
+        self.instance = None
+        self.import_time = None
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.to_register = [CommandInfo(name, self.lazy(name), shorthelp, _type=_type, alias=alias)
+                            for name, shorthelp, _type, alias in entries]
+    def load_config(self, confdict):
+        self.confdict = confdict
+        self.configured = True
+    def load(self):
+        if self.instance is not None:
+            return self.instance
+        with self.lock:
+            if self.instance is None:
+                start = time.perf_counter()
+                mod = importlib.import_module('.' + self.module, __name__)
+                self.import_time = time.perf_counter() - start
+                self.mtime = os.path.getmtime(mod.__file__)
+                instance = getattr(mod, self.clsname)(self.logger)
+                self.configure(instance)
+                names = set(ci.name for ci in instance.to_register)
+                if names != set(ci.name for ci in self.to_register):
+                    self.logger.warning("Manifest entry for {} doesn't match its to_register.".format(self.clsname))
+                self.logger.info("Loaded module {} in {:.3f}s.".format(self.clsname, time.perf_counter() - start))
+                self.instance = instance
+        return self.instance
+    def configure(self, instance):
+        if self.configured:
+            instance.load_config(self.confdict)
+            if self.confdict is not None:
+                instance.load_common_config(self.confdict)
+    def changed(self):
+        mod = sys.modules.get('{}.{}'.format(__name__, self.module))
+        return self.instance is not None and mod is not None and os.path.getmtime(mod.__file__) != self.mtime
+    def reload(self):
+        with self.lock:
+            start = time.perf_counter()
+            mod = sys.modules['{}.{}'.format(__name__, self.module)]
+            self.mtime = os.path.getmtime(mod.__file__)
+            mod = importlib.reload(mod)
+            instance = getattr(mod, self.clsname)(self.logger)
+            self.instance.checkpoint()
+            # State is handed over before load_config, so plugins can skip
+            # reading back anything they were given.
+            instance.takeover(self.instance.handover())
+            self.configure(instance)
+            self.to_register = [CommandInfo(ci.name, self.lazy(ci.name), ci.helpmsg, _type=ci.type,
+                                            alias=ci.alias, filter=ci.filter) for ci in instance.to_register]
+            self.instance = instance
+            self.logger.info("Reloaded module {} in {:.3f}s.".format(self.clsname, time.perf_counter() - start))
+    def lazy(self, name):
+        def call(*args):
+            return self.load().command_info(name).func(*args)
+        return call
+    def get_help_msg(self, cmd):
+        return self.load().get_help_msg(cmd)
+    def checkpoint(self):
+        if self.instance is not None:
+            self.instance.checkpoint()
+    def on_exit(self):
+        if self.instance is not None:
+            self.instance.on_exit()
+
+_modules = dict((clsname, module) for clsname, module, _, _ in manifest)
+
+def __getattr__(name):
+    if name in _modules:
+        mod = importlib.import_module('.' + _modules[name], __name__)
+        return getattr(mod, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 __all__ = [
     'CommandBase',
@@ -1,17 +1,108 @@
+import os
+import re
+import json
+import time
 import shlex
+import pickle
+import hashlib
+import datetime
+import threading
+import fcntl
+import requests
 from enum import Enum
+from contextlib import contextmanager
+from telegram.error import BadRequest
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telegram.ext import Filters
+from .metrics import metrics
+from .sendqueue import background, resolve
+
+_needs_shlex = re.compile(r'[\'"\\]')
+
+def parse_command(update):
+    args = getattr(update, 'parsed_args', None)
+    if args is None:
+        text = update.message.text
+        if _needs_shlex.search(text) is None:
+            args = text.split()
+        else:
+            try:
+                args = shlex.split(text)
+            except ValueError:
+                args = text.split()
+        update.parsed_args = args
+    return args
+
+def command_name(token):
+    return token.lstrip('/').split('@')[0]
+
+class UsageError(Exception):
+    pass
+
+class Arg:
+    def __init__(self, name, optional=False):
+        self.name = name
+        self.optional = optional
+    def convert(self, value):
+        return value
+
+class IntArg(Arg):
+    def __init__(self, name, low=None, high=None, optional=False):
+        super().__init__(name, optional)
+        self.low = low
+        self.high = high
+    def convert(self, value):
+        try:
+            value = int(value)
+        except ValueError:
+            value = None
+        if value is None or (self.low is not None and value < self.low) or \
+           (self.high is not None and value > self.high):
+            if self.low is not None and self.high is not None:
+                raise UsageError("This is not a valid {} ({} <= {} <= {}).".format(
+                    self.name, self.low, self.name, self.high))
+            raise UsageError("This is not a valid {}.".format(self.name))
+        return value
+
+class ChoiceArg(Arg):
+    def __init__(self, name, choices, optional=False):
+        super().__init__(name, optional)
+        self.choices = choices
+    def convert(self, value):
+        if value not in self.choices:
+            raise UsageError("This doesn't seem to be a valid {}.".format(self.name))
+        return value
+
+def check_args(info, args):
+    required = len([x for x in info.args if not x.optional])
+    if not required <= len(args) <= len(info.args):
+        raise UsageError("This doesn't seem like correct usage of /{}.".format(info.name))
+    return [spec.convert(value) for spec, value in zip(info.args, args)]
 
 def bot_command(func):
     def do(self, bot, update):
-        argsx = shlex.split(update.message.text)
+        argsx = ['/' + func.__name__]
         try:
-            func(self, bot, update, args=argsx[1:])
+            argsx = parse_command(update)
+            args = argsx[1:]
+            info = self.command_info(command_name(argsx[0]))
+            if info is not None and info.args is not None:
+                args = check_args(info, args)
+            func(self, bot, update, args=args)
             self.logger.info("Command {} executed successfully.".format(argsx[0]))
+        except UsageError as e:
+            bot.send_message(chat_id = update.message.chat_id,
+                             text = str(e),
+                             disable_notification = True)
         except Exception as e:
-            bot.send_photo(chat_id = update.message.chat_id,
-                           photo = r'http://i3.kym-cdn.com/photos/images/newsfeed/000/234/739/fa5.jpg',
-                           disable_notification = True)
+            metrics.fail()
+            self.send_photo(bot, chat_id = update.message.chat_id,
+                            photo = r'http://i3.kym-cdn.com/photos/images/newsfeed/000/234/739/fa5.jpg',
+                            disable_notification = True)
             errfmt = '{}: {}'.format(argsx[0], str(e))
             self.logger.error(errfmt)
     return do
@@ -21,26 +112,518 @@ class CommandType(Enum):
     Monitor = 1
     Schedule = 2
 
+# Newer python-telegram-bot versions count commands as text, and a monitor
+# seeing them first would keep the command handlers from running.
 class CommandInfo:
     def __init__(self, name, func, shorthelp, _type=CommandType.Default, 
-                 alias=None, filter=Filters.text):
+                 alias=None, filter=Filters.text & ~Filters.command, args=None):
         self.name = name
         self.func = func
         self.helpmsg = shorthelp
         self.type = _type
         self.alias = alias
         self.filter = filter
+        self.args = args
+
+class HttpClient:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = dict()
+        self.sess = None
+        self.configure()
+    def configure(self, connect_timeout=3.05, read_timeout=10, retries=2,
+                  backoff=0.3, pool_size=10, host_limit=4):
+        self.timeout = (connect_timeout, read_timeout)
+        self.host_limit = host_limit
+        retry = Retry(total = retries, connect = retries, read = retries,
+                      backoff_factor = backoff, status_forcelist = (500, 502, 503, 504),
+                      raise_on_status = False)
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size,
+                              max_retries = retry)
+        sess = requests.Session()
+        sess.mount('http://', adapter)
+        sess.mount('https://', adapter)
+        old, self.sess = self.sess, sess
+        with self.lock:
+            self.hosts = dict()
+        if old is not None:
+            old.close()
+    def host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.host_limit)
+            return self.hosts[host]
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self.host_slot(url):
+            start = time.perf_counter()
+            try:
+                return self.sess.request(method, url, **kwargs)
+            finally:
+                metrics.add_upstream(time.perf_counter() - start)
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+    def close(self):
+        self.sess.close()
+
+class MemoryBackend:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+class DiskBackend:
+    def __init__(self, folder, max_entries=4096):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        files = [x for x in os.listdir(folder) if x.endswith('.cache')]
+        files.sort(key = lambda x: os.path.getmtime(os.path.join(folder, x)))
+        self.order = OrderedDict((x, None) for x in files)
+    def filename(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache'
+    def get(self, key):
+        fn = self.filename(key)
+        try:
+            with open(os.path.join(self.folder, fn), 'rb') as f:
+                stored_key, entry = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if stored_key != key:
+            return None
+        with self.lock:
+            if fn in self.order:
+                self.order.move_to_end(fn)
+        return entry
+    def set(self, key, entry):
+        fn = self.filename(key)
+        path = os.path.join(self.folder, fn)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            pickle.dump((key, entry), f)
+        os.replace(tmp, path)
+        with self.lock:
+            self.order[fn] = None
+            self.order.move_to_end(fn)
+            while len(self.order) > self.max_entries:
+                old, _ = self.order.popitem(last = False)
+                try:
+                    os.remove(os.path.join(self.folder, old))
+                except OSError:
+                    pass
+
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.lock = threading.Lock()
+        self.in_flight = dict()
+        self.stats = dict()
+    def count(self, namespace, what):
+        with self.lock:
+            counts = self.stats.setdefault(namespace, dict(hit = 0, stale = 0, miss = 0))
+            counts[what] += 1
+    def fetch(self, namespace, key, func, ttl, stale=0):
+        fullkey = '{}:{!r}'.format(namespace, key)
+        entry = self.backend.get(fullkey)
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < ttl:
+                self.count(namespace, 'hit')
+                return entry[1]
+            if age < ttl + stale:
+                self.count(namespace, 'stale')
+                self.load(fullkey, func, wait = False)
+                return entry[1]
+        self.count(namespace, 'miss')
+        return self.load(fullkey, func)
+    def load(self, fullkey, func, wait=True):
+        with self.lock:
+            fut = self.in_flight.get(fullkey)
+            leader = fut is None
+            if leader:
+                fut = self.in_flight[fullkey] = Future()
+        if not leader:
+            return fut.result() if wait else None
+        if wait:
+            self.run(fullkey, func, fut)
+            return fut.result()
+        threading.Thread(target = self.run, args = (fullkey, func, fut), daemon = True).start()
+    def run(self, fullkey, func, fut):
+        try:
+            value = func()
+            self.backend.set(fullkey, (time.time(), value))
+            fut.set_result(value)
+        except Exception as e:
+            fut.set_exception(e)
+        finally:
+            with self.lock:
+                del self.in_flight[fullkey]
+
+class PrefetchPool:
+    executor = ThreadPoolExecutor(max_workers = 4)
+    fill_attempts = 10
+    recent_chats = 1000
+    def __init__(self, fetch, key=None, low=2, high=5, recent=50, logger=None):
+        self.fetch = fetch
+        self.key = key or (lambda item: item)
+        self.low = low
+        self.high = high
+        self.recent_size = recent
+        self.logger = logger
+        self.items = deque()
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.filling = False
+    def take(self, chat_id):
+        with self.lock:
+            served = self.recent.get(chat_id)
+            if served is None:
+                served = self.recent[chat_id] = deque(maxlen = self.recent_size)
+                while len(self.recent) > self.recent_chats:
+                    self.recent.popitem(last = False)
+            self.recent.move_to_end(chat_id)
+            item = None
+            for candidate in self.items:
+                if self.key(candidate) not in served:
+                    item = candidate
+                    break
+            if item is not None:
+                self.items.remove(item)
+        if item is None:
+            for _ in range(3):
+                fetched = self.fetch()
+                if not fetched:
+                    break
+                item = fetched[0]
+                if self.key(item) not in served:
+                    break
+            if item is None:
+                raise Exception("Couldn't fetch anything to show.")
+        with self.lock:
+            served.append(self.key(item))
+        self.refill()
+        return item
+    def refill(self):
+        with self.lock:
+            if self.filling or len(self.items) >= self.low or self.high <= 0:
+                return
+            self.filling = True
+        self.executor.submit(self.fill)
+    def fill(self):
+        try:
+            for _ in range(self.fill_attempts):
+                if len(self.items) >= self.high:
+                    break
+                fetched = self.fetch()
+                if not fetched:
+                    break
+                with self.lock:
+                    self.items.extend(fetched[:self.high - len(self.items)])
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(e)
+        finally:
+            with self.lock:
+                self.filling = False
+
+class FileIdCache:
+    def __init__(self, path=None, max_entries=2048):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+        if path and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.entries = OrderedDict(json.load(f))
+    def __contains__(self, url):
+        with self.lock:
+            return url in self.entries
+    def get(self, url):
+        with self.lock:
+            file_id = self.entries.get(url)
+            if file_id is not None:
+                self.entries.move_to_end(url)
+            return file_id
+    def set(self, url, file_id):
+        with self.lock:
+            self.entries[url] = file_id
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+            self.dirty = True
+    def discard(self, url):
+        with self.lock:
+            if self.entries.pop(url, None) is not None:
+                self.dirty = True
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(list(self.entries.items()))
+            self.dirty = False
+        atomic_write(self.path, data)
+
+def atomic_write(path, data, mode='w'):
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# Which chats this process handles when chats are split across worker
+# processes (see kadebot.py). Files the workers share are locked while they
+# are written, and per-process caches get a file each.
+class Shard:
+    def __init__(self, index=0, count=1):
+        self.index = index
+        self.count = count
+    def owns(self, chat_id):
+        return int(chat_id) % self.count == self.index
+    def path(self, path):
+        if self.count == 1 or not path:
+            return path
+        return '{}.{}'.format(path, self.index)
+    @contextmanager
+    def locked(self, path):
+        if self.count == 1:
+            yield
+            return
+        with open(path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# Daily subscriptions grouped by hour. All chats subscribed to the same hour
+# share one job, which builds the payload once through callback(bot, hour)
+# and then sends it to each chat with the returned function. Changes are
+# appended to a journal of "<chat> <hour>" and "<chat> -" lines, which is
+# rewritten from scratch once it has grown well past the number of
+# subscriptions. When chats are sharded, every worker appends to the same
+# journal but only schedules its own chats.
+class DailySchedule:
+    executor = ThreadPoolExecutor(max_workers = 2)
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.chats = dict()
+        self.jobs = dict()
+        self.job_queue = None
+        self.callback = None
+        self.entries = 0
+        self.shard = CommandBase.shard
+        if os.path.isfile(path):
+            self.chats = dict((chat, hour) for chat, hour in self.read().items() if self.shard.owns(chat))
+            self.entries = float('inf')
+            self.compact()
+    def read(self):
+        chats = dict()
+        if not os.path.isfile(self.path):
+            return chats
+        with open(self.path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2:
+                    continue
+                chat, hour = parts
+                if hour == '-':
+                    chats.pop(int(chat), None)
+                else:
+                    chats[int(chat)] = int(hour)
+        return chats
+    def __contains__(self, chat_id):
+        return chat_id in self.chats
+    def start(self, job_queue, callback):
+        with self.lock:
+            self.job_queue = job_queue
+            self.callback = callback
+            self.jobs = dict()
+            for hour in set(self.chats.values()):
+                self.schedule(hour)
+    def schedule(self, hour):
+        if self.job_queue is not None and hour not in self.jobs:
+            self.jobs[hour] = self.job_queue.run_daily(self.fire, time = datetime.time(hour, 0, 0), context = hour)
+    def add(self, chat_id, hour):
+        with self.lock:
+            self.chats[chat_id] = hour
+            self.append('{} {}'.format(chat_id, hour))
+            self.schedule(hour)
+    def remove(self, chat_id):
+        with self.lock:
+            hour = self.chats.pop(chat_id)
+            self.append('{} -'.format(chat_id))
+            if hour not in self.chats.values() and hour in self.jobs:
+                self.jobs.pop(hour).schedule_removal()
+    def append(self, line):
+        with self.shard.locked(self.path):
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        self.entries += 1
+    def compact(self):
+        with self.lock:
+            if self.entries <= 2 * len(self.chats) + 16:
+                return
+            with self.shard.locked(self.path):
+                # Other workers' chats are only in the journal.
+                chats = self.read() if self.shard.count > 1 else self.chats
+                if chats:
+                    atomic_write(self.path, ''.join('{} {}\n'.format(*x) for x in chats.items()))
+                elif os.path.isfile(self.path):
+                    os.remove(self.path)
+            self.entries = len(self.chats)
+    def fire(self, bot, job):
+        with self.lock:
+            chats = [chat for chat, hour in self.chats.items() if hour == job.context]
+        if chats:
+            self.executor.submit(self.deliver, bot, job.context, chats)
+    def deliver(self, bot, hour, chats):
+        try:
+            send = self.callback(bot, hour)
+        except Exception as e:
+            self.logger.error(e)
+            return
+        # Sends are queued all at once and paced by the send queue.
+        with background():
+            sent = []
+            for chat_id in chats:
+                try:
+                    sent.append(send(chat_id))
+                except Exception as e:
+                    self.logger.error(e)
+        for result in sent:
+            try:
+                resolve(result)
+            except Exception as e:
+                self.logger.error(e)
+        self.logger.info("Sent daily update at {}:00 to {} chats.".format(hour, len(chats)))
+
+# Calls each target on a background thread every interval seconds, so state
+# is written to disk regularly without holding up any handler.
+class Checkpointer:
+    def __init__(self, targets, interval, logger):
+        self.targets = targets
+        self.interval = interval
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.thread = None
+    def start(self):
+        self.thread = threading.Thread(target = self.run, name = 'checkpoint', daemon = True)
+        self.thread.start()
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.checkpoint()
+    def checkpoint(self):
+        for target in self.targets:
+            try:
+                target()
+            except Exception as e:
+                self.logger.error(e)
+    def stop(self):
+        self.stopped.set()
 
 class CommandBase:
     name = "BaseCommand"
     safename = "basecommand"
     description = "Not an actual command, inherit this!"
+    http = HttpClient()
+    cache = ResponseCache()
+    file_ids = FileIdCache()
+    shard = Shard()
+    cache_ttl = 300
+    cache_stale = 0
+    prefetch_low = 2
+    prefetch_high = 5
+    # Attributes handed to the new instance when the plugin is reloaded in
+    # place, and whether this instance was restored that way.
+    keep_state = ()
+    restored = False
     def __init__(self, logger):
         self.logger = logger
         self.to_register = []
+        self.pools = dict()
+        self.dirty = set()
+        self.dirty_lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
     def on_exit(self):
         pass
     def load_config(self, confdict):
         pass
+    def handover(self):
+        return dict((attr, getattr(self, attr)) for attr in self.keep_state)
+    def takeover(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        self.restored = True
+    def mark_dirty(self, key=None):
+        with self.dirty_lock:
+            self.dirty.add(key)
+    def checkpoint(self):
+        with self.checkpoint_lock:
+            with self.dirty_lock:
+                keys, self.dirty = self.dirty, set()
+            if not keys:
+                return
+            try:
+                self.save_state(keys)
+            except Exception:
+                with self.dirty_lock:
+                    self.dirty.update(keys)
+                raise
+    def save_state(self, keys):
+        pass
+    def command_info(self, name):
+        for ci in self.to_register:
+            if name == ci.name or name == ci.alias:
+                return ci
+        return None
+    def load_common_config(self, confdict):
+        self.cache_ttl = confdict.get('cache_ttl', self.cache_ttl)
+        self.cache_stale = confdict.get('cache_stale', self.cache_stale)
+        self.prefetch_low = confdict.get('prefetch_low', self.prefetch_low)
+        self.prefetch_high = confdict.get('prefetch_high', self.prefetch_high)
+    def cached(self, key, func):
+        return self.cache.fetch(self.safename, key, func, self.cache_ttl, self.cache_stale)
+    def send_photo(self, bot, chat_id, photo, **kwargs):
+        file_id = self.file_ids.get(photo)
+        if file_id is not None:
+            try:
+                return bot.send_photo(chat_id = chat_id, photo = file_id, **kwargs)
+            except BadRequest:
+                self.file_ids.discard(photo)
+        msg = bot.send_photo(chat_id = chat_id, photo = photo, **kwargs)
+        if msg is not None and msg.photo:
+            self.file_ids.set(photo, msg.photo[-1].file_id)
+        return msg
+    def prefetched(self, name, chat_id, fetch, key=None):
+        if name not in self.pools:
+            self.pools[name] = PrefetchPool(fetch, key, self.prefetch_low,
+                                            self.prefetch_high, logger = self.logger)
+        return self.pools[name].take(chat_id)
     def get_help_msg(self, cmd):
         raise NotImplementedError
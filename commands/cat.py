@@ -3,7 +3,6 @@
 #   - /cat
 # Configuration: None
 
-import requests
 from .basic import CommandBase, CommandInfo, bot_command
 
 class Cat(CommandBase):
@@ -16,9 +15,12 @@ class Cat(CommandBase):
         ]
     def get_help_msg(self, cmd):
         return "Call /cat with no arguments."
+    def fetch_cat(self):
+        data = self.http.head("https://api.thecatapi.com/api/images/get")
+        return [data.headers["Location"]]
     @bot_command
     def execute(self, bot, update, args):
-        data = requests.head("https://api.thecatapi.com/api/images/get")
-        bot.send_photo(chat_id = update.message.chat_id, 
-                       photo = data.headers["Location"],
-                       disable_notification = True)
+        photo = self.prefetched('cat', update.message.chat_id, self.fetch_cat)
+        self.send_photo(bot, chat_id = update.message.chat_id, 
+                        photo = photo,
+                        disable_notification = True)
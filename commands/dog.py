@@ -1,12 +1,19 @@
 # Dog plugin
 # Commands:
 #   - /dog
-# Configuration: None
+#   - /dogsearch
+# Schedules:
+#   - dogbreeds
+# Configuration:
+# command.dog:
+#   datfile: "path/to/breeds.json" (optional, keeps the breed list across restarts)
 
+import os
+import json
 import shlex
 import string
-import requests
-from .basic import CommandBase, CommandInfo, CommandType, bot_command
+import datetime
+from .basic import CommandBase, CommandInfo, CommandType, Arg, bot_command
 
 _doggos = {
     'germanshepherd': 'German Shepherd',
@@ -16,15 +23,53 @@ _doggos = {
     'westhighland terrier': 'West Highland Terrier'
 }
 
+class BreedIndex:
+    gram_size = 3
+    def __init__(self, names):
+        self.names = sorted(names)
+        self.grams = dict()
+        for idx, name in enumerate(self.names):
+            name = name.lower()
+            seen = set()
+            for size in range(1, self.gram_size + 1):
+                for i in range(len(name) - size + 1):
+                    gram = name[i:i + size]
+                    if gram not in seen:
+                        seen.add(gram)
+                        self.grams.setdefault(gram, []).append(idx)
+    def __len__(self):
+        return len(self.names)
+    def search(self, query, limit):
+        query = query.lower()
+        if len(query) <= self.gram_size:
+            return [self.names[i] for i in self.grams.get(query, [])[:limit]]
+        postings = []
+        for i in range(len(query) - self.gram_size + 1):
+            posting = self.grams.get(query[i:i + self.gram_size])
+            if posting is None:
+                return []
+            postings.append(posting)
+        # Postings are in name order, so walking the rarest one and checking
+        # candidates yields results already sorted.
+        out = []
+        for idx in min(postings, key = len):
+            if query in self.names[idx].lower():
+                out.append(self.names[idx])
+                if len(out) == limit:
+                    break
+        return out
+
 class Dog(CommandBase):
     name = "Dog"
     safename = "dog"
+    keep_state = ('breed_index',)
     def __init__(self, logger):
         super().__init__(logger)
-        self.breed_list = []
+        self.breed_index = BreedIndex([])
+        self.datfile = None
         self.to_register = [
             CommandInfo("dog", self.execute, "Displays a random dog image."),
-            CommandInfo("dogsearch", self.execute_list, "Search for dog breeds."),
+            CommandInfo("dogsearch", self.execute_list, "Search for dog breeds.", args=[Arg("breed")]),
             CommandInfo("dogbreeds", self.breedsetup, "Get list of dog breeds.", 
                         _type=CommandType.Schedule)
         ]
@@ -34,6 +79,11 @@ class Dog(CommandBase):
                     "Call /dog <breed> to get a random image for a specific breed.")
         elif cmd == "dogsearch":
             return "Call /dogsearch <breed> to search all breeds."
+    def load_config(self, confdict):
+        self.datfile = confdict.get('datfile')
+        if not self.restored and self.datfile and os.path.isfile(self.datfile):
+            with open(self.datfile, 'r') as f:
+                self.breed_index = BreedIndex(json.load(f))
     def dogify(self, lst):
         out = ""
         for item in lst[::-1]:
@@ -42,19 +92,24 @@ class Dog(CommandBase):
             else:
                 out += item + '/'
         return out[:-1]
+    def fetch_dog(self):
+        return [self.http.get("https://dog.ceo/api/breeds/image/random").json()]
     @bot_command
     def execute(self, bot, update, **kwargs):
         args = kwargs.get('args')
         if len(args) == 0:
-            urlfmt = "https://dog.ceo/api/breeds/image/random"
+            urlfmt = None
         elif len(args) == 1:
             name = self.dogify(args[0].lower().split(' '))
             urlfmt = "https://dog.ceo/api/breed/{0}/images/random".format(name)
         else:
             name = self.dogify([x.lower() for x in args])
             urlfmt = "https://dog.ceo/api/breed/{0}/images/random".format(name)
-        self.logger.info(urlfmt)
-        data = requests.get(urlfmt).json()
+        if urlfmt is None:
+            data = self.prefetched('dog', update.message.chat_id, self.fetch_dog)
+        else:
+            self.logger.info(urlfmt)
+            data = self.http.get(urlfmt).json()
         self.logger.info(data['message'])
         if len(args) == 0:
             breed = data['message'].split('https://images.dog.ceo/breeds/')[1].split('/')[0].replace('-', ' ')
@@ -63,51 +118,50 @@ class Dog(CommandBase):
                 breed = _doggos[breed]
             else:
                 breed = string.capwords(breed)
-            bot.send_photo(chat_id = update.message.chat_id, 
-                           photo = data["message"],
-                           caption = breed,
-                           disable_notification = True)
+            self.send_photo(bot, chat_id = update.message.chat_id, 
+                            photo = data["message"],
+                            caption = breed,
+                            disable_notification = True)
         else:
-            bot.send_photo(chat_id = update.message.chat_id, 
-                           photo = data["message"],
-                           disable_notification = True)
+            self.send_photo(bot, chat_id = update.message.chat_id, 
+                            photo = data["message"],
+                            disable_notification = True)
     def breedsetup(self, updater):
-        self.update_breeds()
-        updater.job_queue.run_daily(self.update_breeds, None)
-    def update_breeds(self):
-        temp_list = []
-        with requests.Session() as breed_sess:
-            base_breeds = breed_sess.get('https://dog.ceo/api/breeds/list').json()
-            for breed in base_breeds['message']:
-                self.logger.info(" - Getting sub-breeds of {}...".format(breed))
-                sub_breeds = breed_sess.get('https://dog.ceo/api/breed/{0}/list'.format(breed)).json()
-                if len(sub_breeds['message']) == 0:
+        updater.job_queue.run_once(self.update_breeds, 0)
+        updater.job_queue.run_daily(self.update_breeds, datetime.time(4, 0, 0))
+    def update_breeds(self, bot, job):
+        try:
+            temp_list = []
+            all_breeds = self.http.get('https://dog.ceo/api/breeds/list/all').json()
+            for breed, subs in all_breeds['message'].items():
+                if len(subs) == 0:
                     temp_list.append(breed)
                 else:
-                    for sub in sub_breeds['message']:
+                    for sub in subs:
                         temp_list.append(' '.join([sub, breed]))
-                self.logger.info(" - {} collection done.".format(breed))
-        self.breed_list = temp_list
-        self.logger.info("Scheduled task dogbreeds completed.")
+            self.breed_index = BreedIndex(temp_list)
+            if self.datfile:
+                tmp = self.datfile + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(self.breed_index.names, f)
+                os.replace(tmp, self.datfile)
+            self.logger.info("Scheduled task dogbreeds completed.")
+        except Exception as e:
+            self.logger.error(e)
     @bot_command
     def execute_list(self, bot, update, args):
-        if len(self.breed_list) == 0:
+        if len(self.breed_index) == 0:
             bot.send_message(chat_id = update.message.chat_id,
                              text = "Not available, breed list isn't populated.",
                              disable_notification = True)
             self.logger.info("/dogsearch had no list to search.")
             return
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /dogsearch.",
-                             disable_notification = True)
-            return
         out = "Search results: "
-        res = sorted([x for x in self.breed_list if args[0].lower() in x.lower()])
+        res = self.breed_index.search(args[0], 7)
         if len(res) == 0:
             out += "None!"
         else:
-            for r in res[:7]:
+            for r in res:
                 out += "\n - {}".format(r)
         bot.send_message(chat_id = update.message.chat_id, 
                          text = out,
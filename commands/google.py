@@ -7,7 +7,6 @@
 #  csekey: Google Custom Search Engine key
 #  apikey: Custom Search JSON API Key
 
-import requests
 import urllib.parse
 from .basic import CommandBase, CommandInfo, bot_command
 
@@ -48,12 +47,12 @@ class Google(CommandBase):
             'num': 1,
             'searchType': 'image'
         }
-        query = requests.get('https://www.googleapis.com/customsearch/v1', params = searchparams).json()
+        query = self.http.get('https://www.googleapis.com/customsearch/v1', params = searchparams).json()
         if (not 'items' in query) or len(query['items']) < 1:
             bot.send_message(chat_id = update.message.chat_id,
                              text = 'No image results.',
                              disable_notification = True)
         else:
-            bot.send_photo(chat_id = update.message.chat_id,
-                           photo = query['items'][0]['link'])
+            self.send_photo(bot, chat_id = update.message.chat_id,
+                            photo = query['items'][0]['link'])
 
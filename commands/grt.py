@@ -5,8 +5,7 @@
 # Configuration: None
 
 import shlex
-import requests
-from .basic import CommandBase, CommandInfo, bot_command
+from .basic import CommandBase, CommandInfo, Arg, bot_command
 
 class GRT(CommandBase):
     name = "GRT"
@@ -14,19 +13,15 @@ class GRT(CommandBase):
     def __init__(self, logger):
         super().__init__(logger)
         self.to_register = [
-            CommandInfo("grt", self.execute, "Get bus times for a stop and bus number"),
+            CommandInfo("grt", self.execute, "Get bus times for a stop and bus number",
+                        args=[Arg("stop"), Arg("bus")]),
         ]
     def get_help_msg(self, cmd):
         return "Call /grt <stop> <bus> to check bus times."
     @bot_command
     def execute(self, bot, update, args):
-        if len(args) != 2:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /grt.",
-                             disable_notification = True)
-            return
         params = { 'stopId': args[0], 'routeId': args[1] }
-        data = requests.get(r"http://realtimemap.grt.ca/Stop/GetStopInfo", params=params).json()
+        data = self.http.get(r"http://realtimemap.grt.ca/Stop/GetStopInfo", params=params).json()
         times = [(x['TripId'], x['Minutes']) for x in data['stopTimes']]
         if len(times) == 0:
             bot.send_message(chat_id = update.message.chat_id,
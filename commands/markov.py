@@ -6,51 +6,70 @@
 # Configuration:
 # command.markov:
 #   folder: "markov data folder"
+#   memory_budget: 256 (optional, MiB of models kept loaded at once)
+#   max_sentences: 20000 (optional, most recent sentences kept per model)
+#   generate_attempts: 10 (optional, sentences tried per /markov)
+#   generate_timeout: 0.5 (optional, seconds spent trying per /markov)
+#   processes: 2 (optional, worker processes holding the models, 0 for none)
 
 import os
-import json
-import markovify
-from .basic import CommandBase, CommandInfo, CommandType, bot_command
+from .markovchain import convert_json
+from .markovpool import MarkovPool
+from .basic import CommandBase, CommandInfo, CommandType, ChoiceArg, bot_command
 
 class Markov(CommandBase):
     name = "Markov"
     safename = "markov"
-    datfolder = ""
-    users = dict()
+    keep_state = ('pool',)
+    reply_timeout = 30
     def __init__(self, logger):
         super().__init__(logger)
+        self.pool = None
+        self.generate_attempts = 10
+        self.generate_timeout = 0.5
         self.to_register = [
-            CommandInfo("markov", self.execute_generate, "Emulate yourself talking."),
+            CommandInfo("markov", self.execute_generate, "Emulate yourself talking.",
+                        args=[ChoiceArg("model", ("chat",), optional=True)]),
             CommandInfo("markov_monitor", self.monitor_modeling, "Model users.", _type=CommandType.Monitor)
         ]
     def get_help_msg(self, cmd):
-        return "Call /markov to have the Markov model generate text that sounds like you."
+        return "Call /markov to have the Markov model generate text that sounds like you, or /markov chat to sound like this whole chat."
     def load_config(self, confdict):
-        self.datfolder = confdict['folder']
-        if os.path.exists(self.datfolder):
-            for file in os.listdir(self.datfolder):
-                with open(os.path.join(self.datfolder, file), 'r', newline='\n') as f:
-                    udata = f.read()
-                    user = file.split('.json')[0]
-                    ujson = json.loads(udata)
-                    data = markovify.Text.from_dict(ujson)
-                    self.users[user] = data
+        datfolder = confdict['folder']
+        self.generate_attempts = int(confdict.get('generate_attempts', 10))
+        self.generate_timeout = float(confdict.get('generate_timeout', 0.5))
+        # With sharded chats, the first worker converts old models for all.
+        if not self.restored and self.shard.index == 0 and os.path.exists(datfolder):
+            files = os.listdir(datfolder)
+            for file in files:
+                if file.endswith('.json') and file[:-5] + '.markov' not in files:
+                    src = os.path.join(datfolder, file)
+                    convert_json(src, os.path.join(datfolder, file[:-5] + '.markov'))
+                    os.rename(src, src + '.migrated')
+                    self.logger.info("  Converted Markov data for {}".format(file[:-5]))
+        if self.pool is None:
+            # The budget is for the whole bot, so sharded workers split it.
+            self.pool = MarkovPool(datfolder,
+                                   int(confdict.get('memory_budget', 256)) * 1024 * 1024 // self.shard.count,
+                                   int(confdict.get('max_sentences', 20000)),
+                                   int(confdict.get('processes', 2)),
+                                   self.logger)
+    def model_names(self, message):
+        return '{}_{}'.format(message.chat_id, message.from_user.id), str(message.chat_id)
+    def save_state(self, names):
+        self.pool.save(names)
     def on_exit(self):
         self.logger.info("  Saving collected Markov data..")
-        if not os.path.exists(self.datfolder):
-            os.makedirs(self.datfolder)
-        for user in self.users:
-            udata = self.users[user].to_json()
-            with open(os.path.join(self.datfolder, '{}.json'.format(user)), 'w', newline='\n') as f:
-                f.write(udata)
+        self.pool.stop()
         self.logger.info("  Done saving.")
     @bot_command
     def execute_generate(self, bot, update, args):
-        user = 'markov_model'
-        if user in self.users:
-            out = None
-            while out == None:
-                out = self.users[user].make_sentence()
+        user_model, chat_model = self.model_names(update.message)
+        name = chat_model if args else user_model
+        # Generation runs in the model's worker process, so waiting here
+        # doesn't hold up other handlers.
+        out = self.pool.generate(name, self.generate_attempts, self.generate_timeout).result(self.reply_timeout)
+        if out is not None:
             bot.send_message(chat_id = update.message.chat_id,
                              text = out,
                              disable_notification = True)
@@ -60,16 +79,14 @@ class Markov(CommandBase):
                              disable_notification = True)
     def monitor_modeling(self, bot, update):
         try:
-            user = 'markov_model'
             intext = update.message.text
             if intext[-1] not in '.!?':
                 intext += '.'
-            new = markovify.Text(intext, state_size = 3)
             self.logger.info("  Adding to a Markov model..")
-            if user not in self.users:
-                self.users[user] = new
-            else:
-                self.users[user] = markovify.combine(models=[self.users[user], new])
+            names = self.model_names(update.message)
+            self.pool.add(names, intext)
+            for name in names:
+                self.mark_dirty(name)
             self.logger.info("  Adding done.")
             self.logger.info("markov_monitor processing completed successfully.")
         except Exception as e:
@@ -0,0 +1,473 @@
+# Markov chain helpers shared by the Markov and SonnetGen plugins.
+#
+# IncrementalText behaves exactly like a markovify.Text, except that new text
+# can be folded into an existing model with add_text() in time proportional to
+# the size of the new text, instead of rebuilding the whole model through
+# markovify.combine.
+
+import os
+import mmap
+import json
+import array
+import bisect
+import random
+import struct
+import time
+import markovify
+from collections import deque
+from itertools import accumulate
+from markovify.chain import BEGIN, END
+from .basic import atomic_write
+
+class IncrementalChain(markovify.Chain):
+    def __init__(self, corpus, state_size, model=None):
+        super().__init__(corpus, state_size, model)
+        self.begin_dirty = False
+    def add_run(self, run):
+        items = ([BEGIN] * self.state_size) + run + [END]
+        for i in range(len(run) + 1):
+            state = tuple(items[i:i + self.state_size])
+            follow = items[i + self.state_size]
+            nexts = self.model.get(state)
+            if nexts is None:
+                nexts = self.model[state] = {}
+            nexts[follow] = nexts.get(follow, 0) + 1
+        # The cached begin distribution covers every sentence start, so it is
+        # only rebuilt when a sentence is generated, not once per message.
+        self.begin_dirty = True
+    def move(self, state):
+        if self.begin_dirty:
+            self.precompute_begin_state()
+            self.begin_dirty = False
+        return super().move(state)
+
+class IncrementalText(markovify.Text):
+    def __init__(self, input_text, state_size=2, chain=None, parsed_sentences=None, **kwargs):
+        super().__init__(input_text, state_size, chain, parsed_sentences, **kwargs)
+        if not isinstance(self.chain, IncrementalChain):
+            self.chain = IncrementalChain(None, self.chain.state_size, self.chain.model)
+        self.rejoin_dirty = False
+    def add_text(self, text):
+        runs = list(self.generate_corpus(text))
+        for run in runs:
+            self.chain.add_run(run)
+        if self.retain_original and runs:
+            self.parsed_sentences.extend(runs)
+            self.rejoin_dirty = True
+        return len(runs)
+    def make_sentence(self, init_state=None, **kwargs):
+        if self.rejoin_dirty:
+            self.rejoined_text = self.sentence_join(map(self.word_join, self.parsed_sentences))
+            self.rejoin_dirty = False
+        return super().make_sentence(init_state, **kwargs)
+
+# Compact model files
+#
+# A .markov file holds a whole model in flat arrays, so it can be mapped into
+# memory and used without parsing. Every word is replaced by its index in a
+# sorted token table, states are sorted tuples of token indexes, and each
+# state points at a run of (token, cumulative weight) edges that can be
+# sampled with bisect. The original sentences are kept as one UTF-8 blob, one
+# sentence per line, for markovify's overlap test. All integers are native-endian uint32 except the
+# text length and sentence count.
+#
+# Version 1 files joined the sentences with spaces instead. They can still be
+# loaded, and are rewritten in the current version the next time they are
+# saved.
+
+MAGIC = b'KBMARKOV'
+VERSION = 2
+ENDIAN_MARK = 0x01020304
+HEADER = struct.Struct('=8sIIIIIIQQ')
+
+def _align(n):
+    return (n + 7) & ~7
+
+def write_compact(path, state_size, model, text, sentences):
+    tokens = set()
+    for state, nexts in model.items():
+        tokens.update(state)
+        tokens.update(nexts)
+    tokens = sorted(tokens, key = lambda x: x.encode('utf-8'))
+    ids = dict((tok, idx) for idx, tok in enumerate(tokens))
+    encoded = [tok.encode('utf-8') for tok in tokens]
+    token_off = array.array('I', [0])
+    for tok in encoded:
+        token_off.append(token_off[-1] + len(tok))
+    states = sorted((tuple(ids[w] for w in state), nexts) for state, nexts in model.items())
+    state_keys = array.array('I')
+    edge_start = array.array('I', [0])
+    edge_token = array.array('I')
+    edge_cum = array.array('I')
+    for key, nexts in states:
+        state_keys.extend(key)
+        total = 0
+        for word, count in nexts.items():
+            total += count
+            edge_token.append(ids[word])
+            edge_cum.append(total)
+        edge_start.append(len(edge_token))
+    text = text.encode('utf-8')
+    out = bytearray(HEADER.pack(MAGIC, ENDIAN_MARK, VERSION, state_size, len(tokens),
+                                len(states), len(edge_token), len(text), sentences))
+    for part in (token_off.tobytes(), b''.join(encoded), state_keys.tobytes(),
+                 edge_start.tobytes(), edge_token.tobytes(), edge_cum.tobytes(), text):
+        out += bytes(_align(len(out)) - len(out))
+        out += part
+    atomic_write(path, bytes(out), 'wb')
+
+class CompactModel:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        (magic, mark, version, self.state_size, n_tokens, n_states,
+         n_edges, text_len, self.sentences) = HEADER.unpack_from(self.mm)
+        self.version = version
+        if magic != MAGIC or mark != ENDIAN_MARK or version not in (1, VERSION):
+            raise ValueError("{} is not a compact Markov model for this machine.".format(path))
+        view = memoryview(self.mm)
+        pos = HEADER.size
+        def section(size, fmt = None):
+            nonlocal pos
+            start = _align(pos)
+            pos = start + size
+            part = view[start:pos]
+            return part.cast(fmt) if fmt else part
+        self.token_off = section(4 * (n_tokens + 1), 'I')
+        section(self.token_off[-1])
+        self.blob_start = pos - self.token_off[-1]
+        self.state_keys = section(4 * n_states * self.state_size, 'I')
+        self.edge_start = section(4 * (n_states + 1), 'I')
+        self.edge_token = section(4 * n_edges, 'I')
+        self.edge_cum = section(4 * n_edges, 'I')
+        self.text = section(text_len)
+        self.text_start = pos - text_len
+        self.n_tokens = n_tokens
+        self.n_states = n_states
+    def token_bytes(self, idx):
+        return self.mm[self.blob_start + self.token_off[idx]:self.blob_start + self.token_off[idx + 1]]
+    def token(self, idx):
+        return self.token_bytes(idx).decode('utf-8')
+    def token_id(self, word):
+        word = word.encode('utf-8')
+        lo, hi = 0, self.n_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.token_bytes(mid) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_tokens and self.token_bytes(lo) == word:
+            return lo
+        return None
+    def state_index(self, key):
+        size = self.state_size
+        keys = self.state_keys
+        lo, hi = 0, self.n_states
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tuple(keys[mid * size:(mid + 1) * size]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_states and tuple(keys[lo * size:(lo + 1) * size]) == key:
+            return lo
+        return None
+    def edges(self, key):
+        idx = self.state_index(key)
+        if idx is None:
+            return None
+        start, end = self.edge_start[idx], self.edge_start[idx + 1]
+        return self.edge_token[start:end], self.edge_cum[start:end]
+    def contains_text(self, sub):
+        return self.mm.find(sub.encode('utf-8'), self.text_start) != -1
+    def items(self):
+        size = self.state_size
+        for idx in range(self.n_states):
+            state = tuple(self.token(x) for x in self.state_keys[idx * size:(idx + 1) * size])
+            start, end = self.edge_start[idx], self.edge_start[idx + 1]
+            prev = 0
+            nexts = dict()
+            for tok, cum in zip(self.edge_token[start:end], self.edge_cum[start:end]):
+                nexts[self.token(tok)] = cum - prev
+                prev = cum
+            yield state, nexts
+    def sentences_text(self):
+        return str(self.text, 'utf-8')
+    def size(self):
+        return len(self.mm)
+
+# Chain over a mapped CompactModel plus an in-memory dict of counts learned
+# since the file was written. States are looked up in both and sampled from
+# the summed counts, so the result matches a chain built from all the text.
+class MappedChain:
+    def __init__(self, base, state_size):
+        self.base = base
+        self.state_size = state_size
+        self.delta = dict()
+    def add_run(self, run):
+        items = ([BEGIN] * self.state_size) + run + [END]
+        for i in range(len(run) + 1):
+            state = tuple(items[i:i + self.state_size])
+            follow = items[i + self.state_size]
+            nexts = self.delta.get(state)
+            if nexts is None:
+                nexts = self.delta[state] = {}
+            nexts[follow] = nexts.get(follow, 0) + 1
+    def base_key(self, state):
+        if self.base is None:
+            return None
+        key = tuple(self.base.token_id(w) for w in state)
+        return None if None in key else key
+    def move(self, state, key = None, rng = random):
+        edges = None
+        if self.base is not None:
+            if key is None:
+                key = self.base_key(state)
+            if key is not None:
+                edges = self.base.edges(key)
+        extra = self.delta.get(state)
+        base_total = edges[1][-1] if edges else 0
+        extra_total = sum(extra.values()) if extra else 0
+        if base_total + extra_total == 0:
+            raise KeyError(state)
+        r = rng.random() * (base_total + extra_total)
+        if r < base_total:
+            tok = edges[0][bisect.bisect(edges[1], r)]
+            return self.base.token(tok), tok
+        r -= base_total
+        for word, count in extra.items():
+            r -= count
+            if r < 0:
+                break
+        return word, None
+    def gen(self, init_state = None, rng = random):
+        state = init_state or (BEGIN,) * self.state_size
+        key = self.base_key(state)
+        while True:
+            word, tok = self.move(state, key, rng)
+            if word == END:
+                break
+            yield word
+            state = state[1:] + (word,)
+            if key is not None and tok is not None:
+                key = key[1:] + (tok,)
+            else:
+                key = self.base_key(state)
+    def walk(self, init_state = None):
+        return list(self.gen(init_state))
+    def merged_model(self):
+        merged = dict()
+        if self.base is not None:
+            merged.update(self.base.items())
+        for state, nexts in self.delta.items():
+            into = merged.setdefault(state, dict())
+            for word, count in nexts.items():
+                into[word] = into.get(word, 0) + count
+        return merged
+
+class MappedText(markovify.Text):
+    # Overlap checks search the mapped sentence blob and the sentences added
+    # since, instead of one big in-memory string.
+    class Corpus:
+        def __init__(self, text):
+            self.text = text
+            self.extra = ''
+        def __contains__(self, sub):
+            return sub in self.extra or (self.text.base is not None and self.text.base.contains_text(sub))
+    def __init__(self, base = None, state_size = 2, well_formed = True):
+        self.state_size = base.state_size if base is not None else state_size
+        self.well_formed = well_formed
+        self.retain_original = True
+        self.chain = MappedChain(base, self.state_size)
+        self.pending = []
+        self.delta_size = 0
+        self.rejoined_text = MappedText.Corpus(self.chain)
+    @classmethod
+    def load(cls, path):
+        text = cls(CompactModel(path))
+        if os.path.exists(path + '.pending'):
+            with open(path + '.pending', 'r', newline = '\n') as f:
+                for line in f.read().split('\n'):
+                    if line:
+                        text.add_run(line.split(' '))
+        return text
+    def add_run(self, run):
+        self.chain.add_run(run)
+        sentence = self.word_join(run)
+        self.pending.append(sentence)
+        self.rejoined_text.extra += '\n' + sentence
+        self.delta_size += 2 * len(sentence) + 120 * (len(run) + 1)
+    def add_text(self, text):
+        runs = list(self.generate_corpus(text))
+        for run in runs:
+            self.add_run(run)
+        return len(runs)
+    def sentence_count(self):
+        base = self.chain.base
+        return (base.sentences if base is not None else 0) + len(self.pending)
+    # Rough number of bytes held for this model: the mapped file plus the
+    # counts and sentences added since it was written.
+    def memory(self):
+        return (self.chain.base.size() if self.chain.base is not None else 0) + self.delta_size
+    # The sentences of the mapped file. Version 1 files didn't keep sentence
+    # boundaries, so they are found again with markovify's splitter.
+    def base_sentences(self):
+        base = self.chain.base
+        if base is None or not base.sentences:
+            return []
+        if base.version == 1:
+            return self.sentence_split(base.sentences_text())
+        return base.sentences_text().split('\n')
+    def compact(self, path, max_sentences = None):
+        base = self.chain.base
+        count = self.sentence_count()
+        if max_sentences is not None and count > max_sentences:
+            # Keep a sliding window of the most recent sentences and rebuild
+            # the chain from just those.
+            sentences = (self.base_sentences() + self.pending)[-max_sentences:]
+            window = MappedChain(None, self.state_size)
+            for sentence in sentences:
+                window.add_run(sentence.split(' '))
+            write_compact(path, self.state_size, window.delta, '\n'.join(sentences), len(sentences))
+        elif base is not None and base.version == 1:
+            sentences = self.base_sentences() + self.pending
+            write_compact(path, self.state_size, self.chain.merged_model(),
+                          '\n'.join(sentences), len(sentences))
+        else:
+            sentences = [base.sentences_text()] if base is not None and base.sentences else []
+            write_compact(path, self.state_size, self.chain.merged_model(),
+                          '\n'.join(sentences + self.pending), count)
+        self.chain = MappedChain(CompactModel(path), self.state_size)
+        self.pending = []
+        self.delta_size = 0
+        self.rejoined_text = MappedText.Corpus(self.chain)
+        if os.path.exists(path + '.pending'):
+            os.remove(path + '.pending')
+    # New sentences are written to a small side file until they grow past
+    # compact_ratio of the model, then everything is rewritten in one file.
+    def save(self, path, max_sentences = None, compact_ratio = 0.1):
+        base = self.chain.base
+        if base is None or base.version != VERSION or len(self.pending) > compact_ratio * base.sentences:
+            self.compact(path, max_sentences)
+        elif self.pending:
+            atomic_write(path + '.pending', '\n'.join(self.pending))
+
+def convert_json(src, dst):
+    with open(src, 'r', newline = '\n') as f:
+        obj = json.load(f)
+    chain = obj['chain']
+    if isinstance(chain, str):
+        chain = json.loads(chain)
+    model = dict()
+    for state, nexts in chain:
+        if isinstance(nexts, list):
+            words, cumdist = nexts
+            counts = [b - a for a, b in zip([0] + cumdist[:-1], cumdist)]
+            nexts = dict(zip(words, counts))
+        model[tuple(state)] = nexts
+    sentences = [' '.join(run) for run in obj.get('parsed_sentences') or []]
+    write_compact(dst, obj['state_size'], model, '\n'.join(sentences), len(sentences))
+
+# Sentence generation with a bounded cost. Each walk stops after max_words,
+# and make() gives up after a number of attempts or a deadline, whichever
+# comes first. If terminal is given, sampling is restricted to transitions
+# that can still reach the end of a sentence whose last word passes it, so
+# every walk ends well-formed. Passing a seed makes the output repeatable.
+class Generator:
+    def __init__(self, text, terminal = None):
+        self.text = text
+        self.chain = text.chain
+        self.terminal = terminal
+        self.allowed = None
+        self.cache = dict()
+        self.merged = None
+        if terminal is not None:
+            if isinstance(self.chain, MappedChain):
+                self.merged = self.chain.merged_model()
+            self.allowed = self.reachable()
+    def transitions(self):
+        if self.merged is not None:
+            return self.merged.items()
+        if self.chain.compiled:
+            return ((state, nexts[0]) for state, nexts in self.chain.model.items())
+        return self.chain.model.items()
+    def reachable(self):
+        preds = dict()
+        queue = deque()
+        for state, nexts in self.transitions():
+            for word in nexts:
+                if word != END:
+                    preds.setdefault(state[1:] + (word,), []).append(state)
+                elif state[-1] != BEGIN and self.terminal(state[-1]):
+                    queue.append(state)
+        allowed = set(queue)
+        while queue:
+            for prev in preds.get(queue.popleft(), ()):
+                if prev not in allowed:
+                    allowed.add(prev)
+                    queue.append(prev)
+        return allowed
+    def choices(self, state):
+        found = self.cache.get(state)
+        if found is not None:
+            return found
+        if self.merged is not None:
+            counts = self.merged.get(state, dict())
+            words, weights = list(counts.keys()), list(counts.values())
+        elif self.chain.compiled:
+            words, cumdist = self.chain.model.get(state, ([], []))
+            weights = [b - a for a, b in zip([0] + cumdist[:-1], cumdist)]
+        else:
+            counts = self.chain.model.get(state, dict())
+            words, weights = list(counts.keys()), list(counts.values())
+        if self.allowed is not None:
+            keep = [(w, n) for w, n in zip(words, weights)
+                    if (w == END and state[-1] != BEGIN and self.terminal(state[-1])) or
+                       (w != END and state[1:] + (w,) in self.allowed)]
+            words, weights = [w for w, _ in keep], [n for _, n in keep]
+        found = self.cache[state] = (words, list(accumulate(weights)))
+        return found
+    def gen(self, rng):
+        state = (BEGIN,) * self.chain.state_size
+        while True:
+            words, cumdist = self.choices(state)
+            if not words:
+                yield None
+                return
+            word = words[bisect.bisect(cumdist, rng.random() * cumdist[-1])]
+            if word == END:
+                return
+            yield word
+            state = state[1:] + (word,)
+    def walk(self, rng, max_words):
+        if self.allowed is None and isinstance(self.chain, MappedChain):
+            steps = self.chain.gen(None, rng)
+        else:
+            steps = self.gen(rng)
+        words = []
+        try:
+            for word in steps:
+                if word is None or len(words) == max_words:
+                    return None
+                words.append(word)
+        except KeyError:
+            return None
+        return words
+    def make(self, attempts = 10, deadline = 0.5, seed = None, max_words = 60,
+             test_output = True, fallback = True):
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        first = None
+        for _ in range(attempts):
+            words = self.walk(rng, max_words)
+            if words:
+                if not test_output or self.text.test_sentence_output(words, 0.7, 15):
+                    return self.text.word_join(words)
+                if first is None:
+                    first = words
+            if time.perf_counter() - start > deadline:
+                break
+        if fallback and first is not None:
+            return self.text.word_join(first)
+        return None
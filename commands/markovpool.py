@@ -0,0 +1,316 @@
+# Worker processes for Markov models.
+#
+# Building chains and generating sentences is pure Python and holds the GIL,
+# so on a busy bot it slows down polling and every other handler. Here the
+# models live in worker processes instead. Each model name belongs to one
+# worker, picked by a hash of the name, and only that worker loads, updates
+# and saves it. Messages to learn from are collected for a moment and sent to
+# their worker in batches. Generation requests go to the model's worker and
+# return a Future. Checkpoints only queue the changed models for saving. The
+# worker saves one model at a time while it has nothing else to do, so a
+# generation request waits for at most one save.
+#
+# A worker that dies is started again, after a growing delay if it keeps
+# exiting soon after starting, and not at all after max_quick_exits. Its
+# models are then unavailable until the bot restarts.
+#
+# With processes set to 0 the same work runs in the bot process instead.
+
+import os
+import zlib
+import time
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from .markovchain import MappedText, Generator
+
+# Models live on disk and are loaded when first needed. The most recently
+# used ones are kept in memory until their estimated size passes the budget,
+# then the least recently used are saved and dropped.
+class ModelCache:
+    def __init__(self, folder, budget, max_sentences):
+        self.folder = folder
+        self.budget = budget
+        self.max_sentences = max_sentences
+        self.models = OrderedDict()
+        self.sizes = dict()
+        self.total = 0
+    def path(self, name):
+        return os.path.join(self.folder, '{}.markov'.format(name))
+    def loaded(self, name):
+        return self.models.get(name)
+    def get(self, name, create=False):
+        model = self.models.get(name)
+        if model is not None:
+            self.models.move_to_end(name)
+            return model
+        if os.path.exists(self.path(name)):
+            model = MappedText.load(self.path(name))
+        elif create:
+            model = MappedText(state_size = 3)
+        else:
+            return None
+        self.models[name] = model
+        self.resize(name)
+        return model
+    def resize(self, name):
+        size = self.models[name].memory()
+        self.total += size - self.sizes.get(name, 0)
+        self.sizes[name] = size
+    def save(self, name):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.models[name].save(self.path(name), self.max_sentences)
+        self.resize(name)
+    def evict(self):
+        while self.total > self.budget and len(self.models) > 1:
+            name = next(iter(self.models))
+            self.save(name)
+            del self.models[name]
+            self.total -= self.sizes.pop(name)
+    def save_all(self):
+        for name in list(self.models):
+            self.save(name)
+
+# The models one worker owns, and what it can be asked to do with them.
+class ModelStore:
+    def __init__(self, folder, budget, max_sentences):
+        self.models = ModelCache(folder, budget, max_sentences)
+        self.unsaved = deque()
+        self.queued = set()
+    def add(self, batch):
+        for name, text in batch:
+            self.models.get(name, create = True).add_text(text)
+            self.models.resize(name)
+        self.models.evict()
+    def generate(self, name, attempts, timeout):
+        out = None
+        model = self.models.get(name)
+        if model is not None:
+            out = Generator(model).make(attempts, timeout)
+        self.models.evict()
+        return out
+    def save(self, names):
+        for name in names:
+            if name not in self.queued:
+                self.queued.add(name)
+                self.unsaved.append(name)
+    def save_next(self):
+        name = self.unsaved.popleft()
+        self.queued.discard(name)
+        # Models dropped from memory were saved when they were dropped.
+        if self.models.loaded(name) is not None:
+            self.models.save(name)
+    def stop(self):
+        self.models.save_all()
+        self.unsaved.clear()
+        self.queued.clear()
+
+def worker_main(folder, budget, max_sentences, conn):
+    store = ModelStore(folder, budget, max_sentences)
+    while True:
+        if store.unsaved and not conn.poll():
+            try:
+                store.save_next()
+            except Exception as e:
+                logging.error(e)
+            continue
+        try:
+            ident, op, args = conn.recv()
+        except EOFError:
+            # The bot is gone, so keep what was learned and exit.
+            ident, op, args = None, 'stop', ()
+        result, error = None, None
+        try:
+            result = getattr(store, op)(*args)
+        except Exception as e:
+            error = str(e)
+        if ident is not None:
+            try:
+                conn.send((ident, result, error))
+            except OSError:
+                pass
+        if op == 'stop':
+            return
+
+class MarkovPool:
+    batch_interval = 0.05
+    quick_exit = 30
+    max_quick_exits = 5
+    def __init__(self, folder, budget, max_sentences, processes=2, logger=logging):
+        self.args = (folder, budget // max(processes, 1), max_sentences)
+        self.logger = logger
+        self.local = None
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.stopping = False
+        if processes == 0:
+            self.local = ModelStore(*self.args)
+            return
+        self.context = multiprocessing.get_context('spawn')
+        self.procs = [None] * processes
+        self.conns = [None] * processes
+        self.send_locks = [threading.Lock() for _ in range(processes)]
+        self.futures = [dict() for _ in range(processes)]
+        self.batches = [[] for _ in range(processes)]
+        self.started = [0] * processes
+        self.quick_exits = [0] * processes
+        self.failed = set()
+        for index in range(processes):
+            self.spawn(index)
+        threading.Thread(target = self.flush_loop, name = 'markov-batch', daemon = True).start()
+    def spawn(self, index):
+        conn, child = self.context.Pipe()
+        proc = self.context.Process(target = worker_main, args = self.args + (child,),
+                                    name = "markov{}".format(index), daemon = True)
+        proc.start()
+        child.close()
+        self.started[index] = time.monotonic()
+        with self.send_locks[index]:
+            self.procs[index] = proc
+            self.conns[index] = conn
+        threading.Thread(target = self.listen, args = (index, conn), name = 'markov-listen', daemon = True).start()
+    def listen(self, index, conn):
+        while True:
+            try:
+                ident, result, error = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                fut = self.futures[index].pop(ident, None)
+            if fut is None:
+                continue
+            if error is not None:
+                fut.set_exception(Exception(error))
+            else:
+                fut.set_result(result)
+        self.procs[index].join()
+        with self.lock:
+            lost, self.futures[index] = self.futures[index], dict()
+        for fut in lost.values():
+            fut.set_exception(Exception("Markov worker {} exited.".format(index)))
+        if self.stopping:
+            return
+        if time.monotonic() - self.started[index] < self.quick_exit:
+            self.quick_exits[index] += 1
+        else:
+            self.quick_exits[index] = 0
+        if self.quick_exits[index] >= self.max_quick_exits:
+            self.logger.error("Markov worker {} exited with code {} right after starting {} times, not restarting it.".format(
+                index, self.procs[index].exitcode, self.quick_exits[index]))
+            with self.cond:
+                self.failed.add(index)
+                self.batches[index] = []
+            return
+        delay = 2 ** self.quick_exits[index] - 1
+        self.logger.error("Markov worker {} exited with code {}, restarting it in {}s.".format(
+            index, self.procs[index].exitcode, delay))
+        time.sleep(delay)
+        if not self.stopping:
+            self.spawn(index)
+    def owner(self, name):
+        return zlib.crc32(name.encode('utf-8')) % len(self.procs)
+    def add(self, names, text):
+        if self.local is not None:
+            with self.lock:
+                self.local.add([(name, text) for name in names])
+            return
+        with self.cond:
+            for name in names:
+                index = self.owner(name)
+                if index not in self.failed:
+                    self.batches[index].append((name, text))
+            self.cond.notify()
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                while not any(self.batches):
+                    self.cond.wait()
+            # Let a few more messages arrive before sending.
+            time.sleep(self.batch_interval)
+            for index in range(len(self.procs)):
+                self.flush(index)
+    # Sends what was collected for one worker. Holding its send lock keeps
+    # the batch ahead of any request that comes after it.
+    def flush(self, index):
+        with self.send_locks[index]:
+            # Messages for a worker waiting to be restarted stay queued.
+            if not self.procs[index].is_alive():
+                return
+            with self.cond:
+                batch, self.batches[index] = self.batches[index], []
+            if not batch:
+                return
+            try:
+                self.conns[index].send((None, 'add', (batch,)))
+            except OSError as e:
+                # The worker is being restarted, so try again on the next flush.
+                self.logger.warning("Couldn't pass messages to Markov worker {}: {}".format(index, e))
+                with self.cond:
+                    self.batches[index] = batch + self.batches[index]
+                    self.cond.notify()
+    def call(self, index, op, *args):
+        fut = Future()
+        if index in self.failed:
+            fut.set_exception(Exception("Markov worker {} isn't running.".format(index)))
+            return fut
+        with self.lock:
+            self.seq += 1
+            ident = self.seq
+            self.futures[index][ident] = fut
+        self.flush(index)
+        try:
+            with self.send_locks[index]:
+                self.conns[index].send((ident, op, args))
+        except OSError as e:
+            with self.lock:
+                self.futures[index].pop(ident, None)
+            fut.set_exception(e)
+        return fut
+    def run_local(self, op, *args):
+        fut = Future()
+        try:
+            with self.lock:
+                fut.set_result(getattr(self.local, op)(*args))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+    def generate(self, name, attempts, timeout):
+        if self.local is not None:
+            return self.run_local('generate', name, attempts, timeout)
+        return self.call(self.owner(name), 'generate', name, attempts, timeout)
+    # Queues the named models for saving, without waiting for the saves.
+    def save(self, names):
+        if self.local is not None:
+            with self.lock:
+                self.local.save(names)
+                while self.local.unsaved:
+                    self.local.save_next()
+            return
+        owned = dict()
+        for name in names:
+            owned.setdefault(self.owner(name), []).append(name)
+        for index, group in owned.items():
+            if index in self.failed:
+                continue
+            self.flush(index)
+            with self.send_locks[index]:
+                self.conns[index].send((None, 'save', (group,)))
+    # Saves every loaded model and stops the workers. A worker that doesn't
+    # finish in time is killed, so the bot can still exit.
+    def stop(self, timeout=60):
+        self.stopping = True
+        if self.local is not None:
+            self.run_local('stop').result()
+            return
+        deadline = time.monotonic() + timeout
+        futures = [(index, self.call(index, 'stop')) for index in range(len(self.procs)) if index not in self.failed]
+        for index, fut in futures:
+            try:
+                fut.result(max(0, deadline - time.monotonic()))
+            except Exception as e:
+                self.logger.error("Markov worker {} didn't stop cleanly: {}".format(index, str(e) or type(e).__name__))
+                self.procs[index].kill()
@@ -0,0 +1,167 @@
+# Per-handler call counts, error counts and latency histograms.
+#
+# Every command, monitor and scheduled job is wrapped with Metrics.track.
+# While a tracked call runs, time spent in CommandBase.http requests and in
+# Telegram send_* calls is added up separately, so slow upstreams and slow
+# sends can be told apart. Metrics can be read in the Prometheus text format
+# over HTTP, or summarised by the /stats admin command.
+
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Histogram:
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+        return float('inf')
+
+class TimedBot:
+    def __init__(self, bot, metrics):
+        self._bot = bot
+        self._metrics = metrics
+    def __getattr__(self, name):
+        attr = getattr(self._bot, name)
+        if not name.startswith('send_') or not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._metrics.add_telegram(time.perf_counter() - start)
+        return timed
+
+class TrackedJobQueue:
+    def __init__(self, job_queue, name, metrics):
+        self._job_queue = job_queue
+        self._name = name
+        self._metrics = metrics
+        self.jobs = []
+    def __getattr__(self, name):
+        attr = getattr(self._job_queue, name)
+        if not name.startswith('run_'):
+            return attr
+        def schedule(callback, *args, **kwargs):
+            job = attr(self._metrics.track(self._name, callback), *args, **kwargs)
+            # Only jobs still to run are kept, for removal on reload.
+            self.jobs = [x for x in self.jobs if not x.removed and x.next_t is not None]
+            self.jobs.append(job)
+            return job
+        return schedule
+
+class TrackedUpdater:
+    def __init__(self, updater, name, metrics):
+        self._updater = updater
+        self.job_queue = TrackedJobQueue(updater.job_queue, name, metrics)
+    def __getattr__(self, name):
+        return getattr(self._updater, name)
+
+class Metrics:
+    parts = ('total', 'upstream', 'telegram')
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.calls = dict()
+        self.errors = dict()
+        self.latency = dict()
+        self.server = None
+    def track(self, name, func):
+        def tracked(bot, *args):
+            state = self.local
+            outer = getattr(state, 'timings', None)
+            state.timings = timings = dict(upstream = 0.0, telegram = 0.0, failed = False)
+            start = time.perf_counter()
+            try:
+                return func(TimedBot(bot, self), *args)
+            except Exception:
+                timings['failed'] = True
+                raise
+            finally:
+                timings['total'] = time.perf_counter() - start
+                state.timings = outer
+                self.record(name, timings)
+        return tracked
+    def record(self, name, timings):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if timings['failed']:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            for part in self.parts:
+                key = (name, part)
+                if key not in self.latency:
+                    self.latency[key] = Histogram()
+                self.latency[key].observe(timings[part])
+    def add(self, part, seconds):
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            timings[part] += seconds
+    def add_upstream(self, seconds):
+        self.add('upstream', seconds)
+    def add_telegram(self, seconds):
+        self.add('telegram', seconds)
+    def fail(self):
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            timings['failed'] = True
+    def render(self):
+        out = []
+        with self.lock:
+            out.append('# TYPE kadebot_calls_total counter')
+            for name, n in sorted(self.calls.items()):
+                out.append('kadebot_calls_total{{handler="{}"}} {}'.format(name, n))
+            out.append('# TYPE kadebot_errors_total counter')
+            for name in sorted(self.calls):
+                out.append('kadebot_errors_total{{handler="{}"}} {}'.format(name, self.errors.get(name, 0)))
+            out.append('# TYPE kadebot_latency_seconds histogram')
+            for (name, part), hist in sorted(self.latency.items()):
+                labels = 'handler="{}",part="{}"'.format(name, part)
+                seen = 0
+                for bound, n in zip(hist.buckets + ('+Inf',), hist.counts):
+                    seen += n
+                    out.append('kadebot_latency_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, seen))
+                out.append('kadebot_latency_seconds_sum{{{}}} {:.6f}'.format(labels, hist.total))
+                out.append('kadebot_latency_seconds_count{{{}}} {}'.format(labels, hist.count))
+        return '\n'.join(out) + '\n'
+    def summary(self):
+        out = []
+        with self.lock:
+            for name, n in sorted(self.calls.items(), key = lambda x: -x[1]):
+                total = self.latency[(name, 'total')]
+                upstream = self.latency[(name, 'upstream')]
+                telegram = self.latency[(name, 'telegram')]
+                out.append('{}: {} calls, {} errors, p50 <{}s, p95 <{}s, avg upstream {:.3f}s, avg send {:.3f}s'.format(
+                    name, n, self.errors.get(name, 0), total.quantile(0.5), total.quantile(0.95),
+                    upstream.total / upstream.count, telegram.total / telegram.count))
+        return out
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+metrics = Metrics()
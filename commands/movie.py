@@ -12,21 +12,22 @@
 import re
 import omdb
 import shlex
-import requests
-from .basic import CommandBase, CommandInfo, bot_command
+from .basic import CommandBase, CommandInfo, Arg, bot_command
 
 class Movie(CommandBase):
     name = 'Movie'
     safename = 'movie'
+    cache_ttl = 86400
     def __init__(self, logger):
         super().__init__(logger)
         self.idmatch = re.compile('tt[0-9]{7}')
         self.to_register = [
-            CommandInfo("movie", self.execute_movie, "Displays movie information."),
-            CommandInfo("moviesearch", self.execute_search, "Searches for a movie.")
+            CommandInfo("movie", self.execute_movie, "Displays movie information.", args=[Arg("id")]),
+            CommandInfo("moviesearch", self.execute_search, "Searches for a movie.", args=[Arg("search")])
         ]
     def load_config(self, confdict):
         self.api = omdb.OMDBClient(apikey = confdict["api_key"])
+        self.api.session = self.http.sess
         self.artkey = confdict['fanart_key'] 
         self.artckey = confdict['fanart_ckey'] 
     def get_help_msg(self, cmd):
@@ -38,18 +39,13 @@ class Movie(CommandBase):
     @bot_command
     def execute_movie(self, bot, update, **kwargs):
         args = kwargs.get('args')
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /movie.",
-                             disable_notification = True)
-            return
         is_movie = self.idmatch.findall(args[0])
         if not is_movie or len(is_movie) == 0:
             bot.send_message(chat_id = update.message.chat_id,
                              text = "That doesn't look like a proper IMDb ID.",
                              disable_notification = True)
             return
-        movie = self.api.get(imdbid = is_movie[0])
+        movie = self.cached(('omdb', is_movie[0]), lambda: self.api.get(imdbid = is_movie[0]))
         output = 'Movie: <a href="http://www.imdb.com/title/{}/">{}</a> ({})\n'.format(movie['imdb_id'], movie['title'], movie['released']) + \
                  "Director(s): {}\n".format(movie['director']) + \
                  "Actors: {}\n".format(movie['actors']) + \
@@ -58,19 +54,20 @@ class Movie(CommandBase):
                  "Awards: {}\n\n".format(movie['awards']) + movie['plot']
 
         if self.artkey and self.artckey:
-            images = requests.get(
+            images = self.cached(('fanart', movie['imdb_id']), lambda: self.http.get(
                 'http://webservice.fanart.tv/v3/movies/{}'.format(movie['imdb_id']),
                 params = { 'api_key': self.artkey, 'client_key': self.artckey }
-            ).json()
+            ).json())
             if 'movieposter' in images:
                 english_posters = [poster for poster in images['movieposter'] if poster['lang'] == 'en']
-                bot.send_photo(chat_id = update.message.chat_id,
-                               photo = english_posters[0]['url'],
-                               disable_notification = True)
-            elif movie['poster'] != "N/A" and requests.get(movie['poster']).status_code == 200:
-                bot.send_photo(chat_id = update.message.chat_id,
-                               photo = movie['poster'],
-                               disable_notification = True)
+                self.send_photo(bot, chat_id = update.message.chat_id,
+                                photo = english_posters[0]['url'],
+                                disable_notification = True)
+            elif movie['poster'] != "N/A" and (movie['poster'] in self.file_ids or
+                                               self.http.get(movie['poster']).status_code == 200):
+                self.send_photo(bot, chat_id = update.message.chat_id,
+                                photo = movie['poster'],
+                                disable_notification = True)
         bot.send_message(chat_id = update.message.chat_id,
                          text = output,
                          parse_mode = 'HTML',
@@ -79,11 +76,6 @@ class Movie(CommandBase):
     @bot_command
     def execute_search(self, bot, update, **kwargs):
         args = kwargs.get('args')
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /moviesearch.",
-                             disable_notification = True)
-            return
         results = self.api.get(search = args[0])
         output = "Results:\n"
         for res in results[:7]:
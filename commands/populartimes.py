@@ -8,10 +8,9 @@
 
 import json
 import shlex
-import requests
 import populartimes
 from itertools import groupby
-from .basic import CommandBase, CommandInfo, bot_command
+from .basic import CommandBase, CommandInfo, Arg, bot_command
 
 class PopularTimes(CommandBase):
     name = "PopularTimes"
@@ -19,7 +18,7 @@ class PopularTimes(CommandBase):
     def __init__(self, logger):
         super().__init__(logger)
         self.to_register = [
-            CommandInfo("popular", self.execute, "See busy times for a place.")
+            CommandInfo("popular", self.execute, "See busy times for a place.", args=[Arg("place")])
         ]
     def load_config(self, confdict):
         self.apikey = confdict["api_key"]
@@ -27,13 +26,8 @@ class PopularTimes(CommandBase):
         return "Call /popular \"<place>\" to see the busy times for that place."
     @bot_command
     def execute(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /popular.",
-                             disable_notification = True)
-            return
         gparams = { "query": args[0], "key": self.apikey }
-        req = requests.get("https://maps.googleapis.com/maps/api/place/textsearch/json", params = gparams)
+        req = self.http.get("https://maps.googleapis.com/maps/api/place/textsearch/json", params = gparams)
         place_info = json.loads(req.text)["results"]
         if len(place_info) == 0:
             bot.send_message(chat_id = update.message.chat_id,
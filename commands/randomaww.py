@@ -25,12 +25,15 @@ class RandomAww(CommandBase):
         self.api.read_only = True
     def get_help_msg(self, cmd):
         return "Call /randomaww with no arguments."
-    @bot_command
-    def execute(self, bot, update, args):
+    def fetch_image(self):
         aww = self.api.subreddit('aww')
         post = aww.random()
         while post.post_hint != "image":
             post = aww.random()
-        bot.send_photo(chat_id = update.message.chat_id, 
-                       photo = post.url,
-                       disable_notification = True)
+        return [post.url]
+    @bot_command
+    def execute(self, bot, update, args):
+        photo = self.prefetched('aww', update.message.chat_id, self.fetch_image)
+        self.send_photo(bot, chat_id = update.message.chat_id, 
+                        photo = photo,
+                        disable_notification = True)
@@ -9,15 +9,92 @@
 # Configuration:
 # command.rss:
 #   data_dir: "path/to/storage"
+#   poll_tick: 60 (optional, seconds between checks for due feeds)
+#   max_connections: 4 (optional, feeds fetched at the same time)
 
 import os
 import glob
+import time
+import sqlite3
 import shlex
-import requests
 import datetime
+import threading
 import feedparser
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from telegram import ParseMode
-from .basic import CommandBase, CommandInfo, CommandType, bot_command
+from .sendqueue import background, resolve
+from .basic import CommandBase, CommandInfo, CommandType, Arg, IntArg, ChoiceArg, bot_command
+
+# Feeds are kept in one SQLite database. With chats sharded across worker
+# processes, each worker only loads and polls the feeds of its own chats.
+class FeedStore:
+    def __init__(self, path, owns=None):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS feeds ('
+                        'chat_id INTEGER NOT NULL, url TEXT NOT NULL, name TEXT NOT NULL, '
+                        'interval INTEGER NOT NULL, last_id TEXT, '
+                        'PRIMARY KEY (chat_id, url))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS feeds_url ON feeds (url)')
+        self.db.commit()
+        self.by_chat = dict()
+        self.by_url = dict()
+        self.pending = dict()
+        for chat_id, url, name, interval, last_id in self.db.execute(
+                'SELECT chat_id, url, name, interval, last_id FROM feeds ORDER BY rowid'):
+            if owns is None or owns(chat_id):
+                self._index(chat_id, (name, url, interval, last_id))
+    def _index(self, chat_id, meta):
+        self.by_chat.setdefault(chat_id, dict())[meta[1]] = meta
+        self.by_url.setdefault(meta[1], set()).add(chat_id)
+    def feeds(self, chat_id):
+        with self.lock:
+            return list(self.by_chat.get(chat_id, dict()).values())
+    def get(self, chat_id, url):
+        with self.lock:
+            return self.by_chat.get(chat_id, dict()).get(url)
+    def subscribers(self, url):
+        with self.lock:
+            return [self.by_chat[chat_id][url] + (chat_id,) for chat_id in self.by_url.get(url, ())]
+    def urls(self):
+        with self.lock:
+            return list(self.by_url.keys())
+    def add(self, chat_id, name, url, interval, last_id):
+        with self.lock:
+            self._index(chat_id, (name, url, interval, last_id))
+            self.db.execute('INSERT OR REPLACE INTO feeds (chat_id, url, name, interval, last_id) '
+                            'VALUES (?, ?, ?, ?, ?)', (chat_id, url, name, interval, last_id))
+            self.db.commit()
+    def remove(self, chat_id, url):
+        with self.lock:
+            del self.by_chat[chat_id][url]
+            self.by_url[url].discard(chat_id)
+            if not self.by_url[url]:
+                del self.by_url[url]
+            self.pending.pop((chat_id, url), None)
+            self.db.execute('DELETE FROM feeds WHERE chat_id = ? AND url = ?', (chat_id, url))
+            self.db.commit()
+    def set_last_id(self, chat_id, url, last_id):
+        with self.lock:
+            meta = self.by_chat.get(chat_id, dict()).get(url)
+            if meta is not None:
+                self.by_chat[chat_id][url] = meta[:3] + (last_id,)
+                self.pending[(chat_id, url)] = last_id
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.db.executemany('UPDATE feeds SET last_id = ? WHERE chat_id = ? AND url = ?',
+                                [(v, k[0], k[1]) for k, v in self.pending.items()])
+            self.db.commit()
+            self.pending.clear()
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
 
 class RSS(CommandBase):
     name = "RSS"
@@ -35,15 +112,26 @@ class RSS(CommandBase):
         '24h': 86400
     }
     int_opts_r = dict((v, k) for k, v in int_opts.items())
+    keep_state = ('store', 'next_due', 'validators', 'latest', 'in_flight')
     def __init__(self, logger):
         super().__init__(logger)
         self.to_register = [
-            CommandInfo("rss", self.execute_rss, "Schedule RSS updates."),
+            CommandInfo("rss", self.execute_rss, "Schedule RSS updates.",
+                        args=[Arg("name"), Arg("url"), ChoiceArg("interval", self.int_opts)]),
             CommandInfo("rssfeeds", self.execute_feeds, "List feeds for this chat."),
-            CommandInfo("rssdel", self.execute_feeddel, "List feeds for this chat."),
+            CommandInfo("rssdel", self.execute_feeddel, "List feeds for this chat.",
+                        args=[IntArg("feed index", 0)]),
             CommandInfo("check_rss", self.setup_rss, "Check feeds.", _type=CommandType.Schedule)
         ]
-        self.feeddict = dict()
+        self.store = None
+        self.next_due = dict()
+        self.validators = dict()
+        self.latest = dict()
+        self.in_flight = set()
+        self.lock = threading.RLock()
+        self.pool = None
+        self.poll_tick = 60
+        self.max_connections = 4
     def get_help_msg(self, cmd):
         if cmd == "rss":
             ints = sorted(self.int_opts.items(), key=lambda x: x[1])
@@ -54,129 +142,155 @@ class RSS(CommandBase):
             return "Call /rssdel <index> to delete the feed at the specified index (from /rssfeeds)."
     def load_config(self, confdict):
         self.datadir = confdict['data_dir']
-        self.feeddict = dict()
+        self.poll_tick = int(confdict.get('poll_tick', 60))
+        self.max_connections = int(confdict.get('max_connections', 4))
         if not os.path.exists(self.datadir):
             os.mkdir(self.datadir)
-        else:
-            for fn in glob.glob(os.path.join(self.datadir, '*.groupfeeds')):
-                shortfn = int(os.path.splitext(os.path.basename(fn))[0])
-                with open(fn, 'r') as f:
-                    toreg = (x.strip().split('||') for x in f.readlines())
-                    self.feeddict[shortfn] = []
-                    for name, feedurl, interval, lastid in toreg:
-                        self.feeddict[shortfn].append((name, feedurl, int(interval), lastid))
+        if self.store is None:
+            self.store = FeedStore(os.path.join(self.datadir, 'feeds.sqlite3'), self.shard.owns)
+        self.migrate_groupfeeds()
+    def migrate_groupfeeds(self):
+        for fn in glob.glob(os.path.join(self.datadir, '*.groupfeeds')):
+            shortfn = int(os.path.splitext(os.path.basename(fn))[0])
+            if not self.shard.owns(shortfn):
+                continue
+            with open(fn, 'r') as f:
+                toreg = [x.strip().split('||') for x in f.readlines() if x.strip()]
+            for name, feedurl, interval, lastid in toreg:
+                if self.store.get(shortfn, feedurl) is None:
+                    self.store.add(shortfn, name, feedurl, int(interval), lastid)
+            os.rename(fn, fn + '.migrated')
+            self.logger.info('  Migrated feeds for {}'.format(shortfn))
+    def handover(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait = False)
+        return super().handover()
+    def checkpoint(self):
+        if self.store is not None:
+            self.store.flush()
     def on_exit(self):
-        if not os.path.exists(self.datadir):
-            os.mkdir(self.datadir)
-        for chat_id in self.feeddict.keys():
-            with open(os.path.join(self.datadir, str(chat_id) + '.groupfeeds'), 'w') as f:
-                if len(self.feeddict[chat_id]) > 0:
-                    self.logger.info('  Saving feeds for {}'.format(chat_id))
-                f.write('\n'.join('||'.join(map(str, x)) for x in self.feeddict[chat_id]))
+        if self.pool is not None:
+            self.pool.shutdown(wait = False)
+        if self.store is not None:
+            self.store.close()
     def setup_rss(self, updater):
-        stagger = 0
         self.temp_upd = updater
-        for chatid in self.feeddict.keys():
-            for feed in self.feeddict[chatid]:
-                updater.job_queue.run_repeating(
-                    self.check_rss, 
-                    interval=datetime.timedelta(seconds=feed[2]),
-                    context=(chatid, feed),
-                    first = stagger
-                )
-                stagger += 5
-    def check_rss(self, bot, job):
-        chat_id, meta = job.context
-        if chat_id not in self.feeddict.keys() or meta not in self.feeddict[chat_id]:
-            job.schedule_removal()
-            return
-        self.logger.info("Checking {}".format(meta[0]))
-        name, feedurl, interval, last_id = meta
+        self.pool = ThreadPoolExecutor(max_workers = self.max_connections)
+        updater.job_queue.run_repeating(
+            self.poll_feeds,
+            interval = datetime.timedelta(seconds = self.poll_tick),
+            first = 0
+        )
+    def poll_feeds(self, bot, job):
+        self.store.flush()
+        now = time.time()
+        due = dict()
+        conditional = dict()
+        with self.lock:
+            for feedurl in self.store.urls():
+                if feedurl in self.in_flight:
+                    continue
+                for name, feedurl, interval, last_id, chat_id in self.store.subscribers(feedurl):
+                    key = (chat_id, feedurl)
+                    if self.next_due.get(key, 0) > now:
+                        continue
+                    self.next_due[key] = now + interval
+                    due.setdefault(feedurl, []).append(chat_id)
+                    # A 304 only means nothing changed since the last fetch,
+                    # which a chat with a longer interval or a failed send
+                    # may not have seen yet.
+                    if feedurl not in self.latest or last_id != self.latest[feedurl]:
+                        conditional[feedurl] = False
+            self.in_flight.update(due.keys())
+        for feedurl, chats in due.items():
+            fut = self.pool.submit(self.fetch_feed, feedurl, conditional.get(feedurl, True))
+            fut.add_done_callback(partial(self.fan_out, bot, feedurl, chats))
+    def fetch_feed(self, feedurl, conditional=True):
+        self.logger.info("Checking {}".format(feedurl))
+        etag, modified = self.validators.get(feedurl, (None, None)) if conditional else (None, None)
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        resp = self.http.get(feedurl, headers = headers)
+        if resp.status_code == 304:
+            self.logger.info("  {} not modified.".format(feedurl))
+            return None
+        resp.raise_for_status()
+        self.validators[feedurl] = (resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+        return feedparser.parse(resp.content, response_headers = dict((k.lower(), v) for k, v in resp.headers.items()))
+    def fan_out(self, bot, feedurl, chats, fut):
         try:
-            feed = feedparser.parse(feedurl)
-            if len(feed['entries']) > 0:
-                startidx = 0
-                recentid = feed['entries'][0]['id']
-                self.logger.info("  Recent ID: {} | Last Saved: {}".format(recentid, last_id))
-                if recentid == last_id:
-                    return
-                out = "<b>{} Feed Update(s):</b>".format(name)
-                outup = []
-                while True:
-                    if startidx >= len(feed['entries']):
-                        break
-                    recent = feed['entries'][startidx]
-                    self.logger.info(" Checking entry with ID {}".format(recent['id']))
-                    if recent['id'] != last_id:
-                        outup.append('\n<a href="{}">{}</a>'.format(recent['link'],recent['title']))
-                        startidx += 1
-                    else:
-                        break
-                out += ''.join(outup[::-1])
-                bot.send_message(chat_id = chat_id,
-                                 parse_mode = ParseMode.HTML,
-                                 text = out,
-                                 disable_notification = False,
-                                 disable_web_page_preview = True)
-                lst = self.feeddict[chat_id]
-                idx = 0
-                for i in range(len(lst)):
-                    if lst[i][1] == feedurl:
-                        self.logger.info("Old entry: {}".format(lst[i]))
-                        lst[i] = (name, feedurl, interval, recentid)
-                        self.logger.info("New entry: {}".format(lst[i]))
-                        idx = i
-                        break
-                self.feeddict[chat_id] = lst
-                job.context = (chat_id, self.feeddict[chat_id][idx])
+            feed = fut.result()
+            if feed is None or len(feed['entries']) == 0:
+                return
+            recentid = feed['entries'][0]['id']
+            with self.lock:
+                self.latest[feedurl] = recentid
+            sent = []
+            # Updates are queued for every chat at once and go out as fast as
+            # the send queue's rate limits allow.
+            with background():
+                for chat_id in chats:
+                    meta = self.store.get(chat_id, feedurl)
+                    if meta is None:
+                        continue
+                    name, feedurl, interval, last_id = meta
+                    self.logger.info("  Recent ID: {} | Last Saved: {}".format(recentid, last_id))
+                    if recentid == last_id:
+                        continue
+                    outup = []
+                    for recent in feed['entries']:
+                        if recent['id'] == last_id:
+                            break
+                        outup.append('\n<a href="{}">{}</a>'.format(recent['link'], recent['title']))
+                    out = "<b>{} Feed Update(s):</b>".format(name) + ''.join(outup[::-1])
+                    try:
+                        sent.append((chat_id, bot.send_message(chat_id = chat_id,
+                                                               parse_mode = ParseMode.HTML,
+                                                               text = out,
+                                                               disable_notification = False,
+                                                               disable_web_page_preview = True)))
+                    except Exception as e:
+                        self.logger.error(e)
+            for chat_id, result in sent:
+                try:
+                    resolve(result)
+                except Exception as e:
+                    self.logger.error(e)
+                    continue
+                self.store.set_last_id(chat_id, feedurl, recentid)
+            self.store.flush()
         except Exception as e:
-            raise(e)
+            self.logger.error(e)
+        finally:
+            with self.lock:
+                self.in_flight.discard(feedurl)
     @bot_command
     def execute_rss(self, bot, update, args):
-        if len(args) != 3:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /rss.",
-                             disable_notification = True)
-            return
-        attempt = requests.head(args[1])
+        attempt = self.http.head(args[1])
         if attempt.status_code not in (200, 429):
             bot.send_message(chat_id = update.message.chat_id,
                              text = "This doesn't seem to be a valid link.",
                              disable_notification = True)
             return
-        if args[2] not in self.int_opts.keys():
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem to be a valid interval.",
-                             disable_notification = True)
-            return
         interval = self.int_opts[args[2]]
-        curid = feedparser.parse(args[1])['entries'][0]['id']
-        if update.message.chat_id in self.feeddict.keys():
-            tryx = self.feeddict[update.message.chat_id]
-        else:
-            self.feeddict[update.message.chat_id] = []
-            tryx = []
-        if args[1] not in [x[0] for x in tryx]:
-            self.feeddict[update.message.chat_id].append((args[0], args[1], interval, curid))
-            self.temp_upd.job_queue.run_repeating(
-                self.check_rss,
-                interval=datetime.timedelta(seconds=interval),
-                context=(update.message.chat_id, (args[0], args[1], interval, curid))
-            )
+        curid = feedparser.parse(self.http.get(args[1]).content)['entries'][0]['id']
+        if self.store.get(update.message.chat_id, args[1]) is None:
+            self.store.add(update.message.chat_id, args[0], args[1], interval, curid)
+            with self.lock:
+                self.next_due[(update.message.chat_id, args[1])] = time.time() + interval
             bot.send_message(chat_id = update.message.chat_id,
                              text = "Your RSS feed has been registered.",
                              disable_notification = True)
     @bot_command
     def execute_feeds(self, bot, update, args):
         chatid = update.message.chat_id
-        if chatid in self.feeddict.keys():
-            if self.feeddict[chatid] is None or len(self.feeddict[chatid]) < 1:
-                bot.send_message(chat_id = chatid,
-                                 text = "You don't have any feeds registered.",
-                                 disable_notification = True)
-                return
+        feeds = self.store.feeds(chatid)
+        if len(feeds) > 0:
             out = "*Your RSS feeds:*"
-            for idx, item in enumerate(self.feeddict[chatid]):
+            for idx, item in enumerate(feeds):
                 out += '\n{}: {} ({})'.format(idx, item[0], self.int_opts_r[item[2]])
             bot.send_message(chat_id = chatid,
                              parse_mode = ParseMode.MARKDOWN,
@@ -188,24 +302,16 @@ class RSS(CommandBase):
                              disable_notification = True)
     @bot_command
     def execute_feeddel(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /rssdel.",
-                             disable_notification = True)
-            return
         chatid = update.message.chat_id
-        if chatid in self.feeddict.keys():
-            if self.feeddict[chatid] is None or len(self.feeddict[chatid]) < 1:
-                bot.send_message(chat_id = chatid,
-                                 text = "You don't have any feeds registered.",
-                                 disable_notification = True)
-                return
-            if args[0].isdigit() and 0 <= int(args[0]) < len(self.feeddict[chatid]):
-                self.feeddict[chatid].pop(int(args[0]))
+        feeds = self.store.feeds(chatid)
+        if len(feeds) > 0:
+            if args[0] < len(feeds):
+                self.store.remove(chatid, feeds[args[0]][1])
+                feeds = self.store.feeds(chatid)
                 out = "Feed deleted successfully."
-                if len(self.feeddict[chatid]) > 0:
+                if len(feeds) > 0:
                     out += "\n\n*Remaining RSS feeds:*"
-                    for idx, item in enumerate(self.feeddict[chatid]):
+                    for idx, item in enumerate(feeds):
                         out += '\n{}: {} ({})'.format(idx, item[0], self.int_opts_r[item[2]])
                 else:
                     out += " You have no feeds remaining."
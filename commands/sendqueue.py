@@ -0,0 +1,246 @@
+# Outbound Telegram send queue.
+#
+# Every message the bot sends goes through one queue that keeps under
+# Telegram's limits: a global token bucket (about 30 messages a second), and
+# one bucket per chat (about one a second in private chats, 20 a minute in
+# groups). Replies to commands go ahead of scheduled broadcasts, messages to
+# one chat keep their order, and a RetryAfter from Telegram holds that chat
+# back for as long as asked and then sends the message again.
+#
+# Plugins keep calling bot.send_message and friends as before. Inside a
+# background() block, sends are queued as broadcasts and return a Future
+# instead of waiting, so a fan-out to many chats goes out as fast as the
+# limits allow. Queued broadcast texts to the same chat with the same options
+# are joined into one message.
+
+import time
+import heapq
+import logging
+import threading
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from telegram import Bot
+from telegram.error import RetryAfter, NetworkError, TimedOut, BadRequest, Unauthorized, ChatMigrated
+
+INTERACTIVE = 0
+BROADCAST = 1
+
+_local = threading.local()
+
+@contextmanager
+def background():
+    outer = getattr(_local, 'background', False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = outer
+
+def resolve(result):
+    if isinstance(result, Future):
+        return result.result()
+    return result
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+    def wait_time(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+class Outgoing:
+    def __init__(self, send, url, data, kwargs, priority):
+        self.send = send
+        self.url = url
+        self.data = data
+        self.kwargs = kwargs
+        self.priority = priority
+        self.futures = [Future()]
+        self.attempts = 0
+    def text_only(self):
+        return self.priority == BROADCAST and self.url.endswith('/sendMessage') and 'text' in self.data
+    def options(self):
+        return (dict((k, v) for k, v in self.data.items() if k != 'text'), self.kwargs)
+    def merge(self, other, limit):
+        if not (self.text_only() and other.text_only()) or self.options() != other.options():
+            return False
+        text = self.data['text'] + '\n\n' + other.data['text']
+        if len(text) > limit:
+            return False
+        self.data['text'] = text
+        self.futures.extend(other.futures)
+        return True
+
+class SendQueue:
+    max_text = 4096
+    network_retries = 3
+    def __init__(self, global_rate=30, private_rate=1, private_burst=3,
+                 group_rate=20 / 60, group_burst=20, workers=8, logger=logging):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private = (private_rate, private_burst)
+        self.group = (group_rate, group_burst)
+        self.workers = workers
+        self.logger = logger
+        self.cond = threading.Condition()
+        self.queues = dict()
+        self.buckets = dict()
+        self.blocked = dict()
+        self.in_flight = set()
+        self.ready = []
+        self.delayed = []
+        self.seq = 0
+        self.stats = dict(sent = 0, merged = 0, retried = 0, failed = 0)
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'send')
+        self.thread = threading.Thread(target = self.run, name = 'sendqueue', daemon = True)
+        self.thread.start()
+    def bucket(self, chat_id):
+        if chat_id not in self.buckets:
+            private = isinstance(chat_id, int) and chat_id > 0
+            rate, burst = self.private if private else self.group
+            self.buckets[chat_id] = TokenBucket(rate, burst)
+        return self.buckets[chat_id]
+    def submit(self, chat_id, send, url, data, kwargs, priority=INTERACTIVE):
+        item = Outgoing(send, url, data, kwargs, priority)
+        with self.cond:
+            queue = self.queues.get(chat_id)
+            if queue is None:
+                queue = self.queues[chat_id] = deque()
+                queue.append(item)
+                self.push(chat_id)
+            else:
+                queue.append(item)
+            self.cond.notify_all()
+        return item.futures[0]
+    # Called with the lock held, for a chat whose next message is waiting
+    # to go out and which isn't already being sent to.
+    def push(self, chat_id):
+        self.seq += 1
+        heapq.heappush(self.ready, (self.queues[chat_id][0].priority, self.seq, chat_id))
+    def pending(self):
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+    # Waits for queued messages to go out, e.g. before a restart.
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.queues:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+    def next_item(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, priority, seq, chat_id = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (priority, seq, chat_id))
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                if self.ready:
+                    wait = self.global_bucket.wait_time(now)
+                    if wait == 0:
+                        priority, seq, chat_id = heapq.heappop(self.ready)
+                        wait = max(self.bucket(chat_id).wait_time(now), self.blocked.get(chat_id, 0) - now)
+                        if wait > 0:
+                            heapq.heappush(self.delayed, (now + wait, priority, seq, chat_id))
+                            continue
+                        self.global_bucket.take(now)
+                        self.bucket(chat_id).take(now)
+                        self.blocked.pop(chat_id, None)
+                        queue = self.queues[chat_id]
+                        item = queue.popleft()
+                        while queue and item.merge(queue[0], self.max_text):
+                            queue.popleft()
+                            self.stats['merged'] += 1
+                        self.in_flight.add(chat_id)
+                        return chat_id, item
+                    timeout = wait if timeout is None else min(timeout, wait)
+                self.cond.wait(timeout)
+    def run(self):
+        while True:
+            chat_id, item = self.next_item()
+            self.executor.submit(self.send, chat_id, item)
+    def send(self, chat_id, item):
+        item.attempts += 1
+        try:
+            result = item.send(item.url, dict(item.data), **item.kwargs)
+        except RetryAfter as e:
+            self.logger.warning("Telegram asked to wait {}s before sending to {}.".format(e.retry_after, chat_id))
+            self.retry(chat_id, item, e.retry_after)
+            return
+        except (BadRequest, Unauthorized, ChatMigrated) as e:
+            # Sending again would fail the same way. BadRequest is a
+            # NetworkError, so this has to come first.
+            self.finish(chat_id, item, error = e)
+            return
+        except TimedOut as e:
+            # The message may have gone through, so don't send it twice.
+            self.finish(chat_id, item, error = e)
+            return
+        except NetworkError as e:
+            if item.attempts < self.network_retries:
+                self.retry(chat_id, item, 2 ** item.attempts)
+                return
+            self.finish(chat_id, item, error = e)
+            return
+        except Exception as e:
+            self.finish(chat_id, item, error = e)
+            return
+        self.finish(chat_id, item, result = result)
+    def retry(self, chat_id, item, delay):
+        with self.cond:
+            self.stats['retried'] += 1
+            self.blocked[chat_id] = time.monotonic() + delay
+            self.queues[chat_id].appendleft(item)
+            self.in_flight.discard(chat_id)
+            self.push(chat_id)
+            self.cond.notify_all()
+    def finish(self, chat_id, item, result=None, error=None):
+        with self.cond:
+            self.stats['failed' if error is not None else 'sent'] += 1
+            self.in_flight.discard(chat_id)
+            if self.queues[chat_id]:
+                self.push(chat_id)
+            else:
+                del self.queues[chat_id]
+                bucket = self.buckets.get(chat_id)
+                if bucket is not None and bucket.wait_time(time.monotonic()) == 0 and bucket.tokens >= bucket.burst:
+                    del self.buckets[chat_id]
+            self.cond.notify_all()
+        for fut in item.futures:
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(result)
+
+# Bot whose sends all go through a SendQueue. Outside background() a send
+# waits for its turn and returns the Message as usual.
+class QueuedBot(Bot):
+    def __init__(self, token, queue, **kwargs):
+        super().__init__(token, **kwargs)
+        self.queue = queue
+    def _message(self, url, data, **kwargs):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # Inline message edits aren't tied to a chat.
+            return super()._message(url, data, **kwargs)
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            pass
+        if getattr(_local, 'background', False):
+            return self.queue.submit(chat_id, super()._message, url, data, kwargs, BROADCAST)
+        return self.queue.submit(chat_id, super()._message, url, data, kwargs, INTERACTIVE).result()
@@ -2,32 +2,159 @@
 # Commands:
 #   - /sonnetgen
 # Monitors: None
-# Configuration: None
+# Schedules:
+#   - sonnet_pool
+# Configuration:
+# command.sonnetgen:
+#   pool_size: 0 (optional, number of sonnets to keep pre-generated)
+#   pool_refill: 60 (optional, seconds between pool refills)
+#   generate_attempts: 10 (optional, tries per line)
+#   generate_timeout: 0.2 (optional, seconds spent trying per line)
+#   processes: 1 (optional, worker processes generating sonnets, 0 for none)
 
 import os
+import time
+import random
+import datetime
+import threading
 import markovify
-from .basic import CommandBase, CommandInfo, bot_command
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .markovchain import Generator
+from .basic import CommandBase, CommandInfo, CommandType, bot_command
 
-dat = None
+_model = None
+_model_lock = threading.Lock()
 
+# Generators for any line, and for a line that ends a sentence.
+def sonnet_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                with open('shakespeare/sonnets.json', 'r') as f:
+                    text = markovify.NewlineText.from_json(f.read()).compile(inplace = True)
+                _model = (Generator(text), Generator(text, terminal = lambda word: word[-1] in '.!?'))
+    return _model
+
+MAX_LINES = 14
+
+def make_sonnet(attempts, timeout, seed=None):
+    free, closing = sonnet_model()
+    rng = random.Random(seed)
+    out = []
+    while len(out) < 5 or out[-1][-1] not in '.!?':
+        # The last allowed line is always one that ends a sentence.
+        gen = closing if len(out) >= MAX_LINES - 1 else free
+        line = gen.make(attempts, timeout, seed = rng.random())
+        if line is None:
+            raise Exception("Couldn't generate a sonnet.")
+        out.append(line)
+    return '\n'.join(out)
+
+# Pool workers exit along with the bot, even if it didn't get to stop them.
+def watch_parent(pid):
+    def watch():
+        while os.getppid() == pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target = watch, daemon = True).start()
+
+# Sonnets are generated in worker processes when processes is above 0, so
+# the pure-Python sampling doesn't hold up other handlers.
 class SonnetGen(CommandBase):
     name = "SonnetGen"
     safename = "sonnetgen"
+    keep_state = ('pool', 'executor')
+    reply_timeout = 30
     def __init__(self, logger):
         super().__init__(logger)
+        self.pool = deque()
+        self.generate_attempts = 10
+        self.generate_timeout = 0.2
+        self.pool_size = 0
+        self.pool_refill = 60
+        self.executor = None
+        self.processes = 1
+        self.executor_lock = threading.Lock()
         self.to_register = [
             CommandInfo("sonnetgen", self.execute, "Generate a brand-new Shakespeare sonnet."),
+            CommandInfo("sonnet_pool", self.setup_pool, "Pre-generate sonnets.", _type=CommandType.Schedule)
         ]
     def get_help_msg(self, cmd):
         return "Call /sonnetgen with no arguments."
+    def load_config(self, confdict):
+        if confdict is not None:
+            self.pool_size = int(confdict.get('pool_size', 0))
+            self.pool_refill = int(confdict.get('pool_refill', 60))
+            self.generate_attempts = int(confdict.get('generate_attempts', 10))
+            self.generate_timeout = float(confdict.get('generate_timeout', 0.2))
+            self.processes = int(confdict.get('processes', 1))
+            # Workers from before a reload still run the old code.
+            if self.executor is not None:
+                self.executor.shutdown(wait = False)
+                self.executor = None
+            if self.processes > 0:
+                self.executor = self.new_executor()
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers = self.processes,
+                                   mp_context = multiprocessing.get_context('spawn'),
+                                   initializer = watch_parent, initargs = (os.getpid(),))
+    # A pool whose worker died (e.g. killed for memory) fails every call
+    # after, so it is replaced with a new one.
+    def restart_executor(self, broken):
+        with self.executor_lock:
+            if self.executor is broken:
+                self.logger.error("A sonnet worker died, starting new ones.")
+                broken.shutdown(wait = False)
+                self.executor = self.new_executor()
+    def on_exit(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+    def submit_sonnet(self, seed=None):
+        executor = self.executor
+        try:
+            return executor, executor.submit(make_sonnet, self.generate_attempts, self.generate_timeout, seed)
+        except BrokenProcessPool:
+            self.restart_executor(executor)
+            executor = self.executor
+            return executor, executor.submit(make_sonnet, self.generate_attempts, self.generate_timeout, seed)
+    def sonnet_result(self, submitted, seed=None):
+        executor, fut = submitted
+        try:
+            return fut.result(self.reply_timeout)
+        except BrokenProcessPool:
+            self.restart_executor(executor)
+            return self.submit_sonnet(seed)[1].result(self.reply_timeout)
+    def make_sonnet(self, seed=None):
+        if self.executor is None:
+            return make_sonnet(self.generate_attempts, self.generate_timeout, seed)
+        return self.sonnet_result(self.submit_sonnet(seed), seed)
+    def setup_pool(self, updater):
+        if self.pool_size > 0:
+            updater.job_queue.run_repeating(
+                self.refill_pool,
+                interval = datetime.timedelta(seconds = self.pool_refill),
+                first = 0
+            )
+    def refill_pool(self, bot, job):
+        try:
+            if self.executor is None:
+                while len(self.pool) < self.pool_size:
+                    self.pool.append(self.make_sonnet())
+                return
+            for submitted in [self.submit_sonnet() for _ in range(self.pool_size - len(self.pool))]:
+                self.pool.append(self.sonnet_result(submitted))
+        except Exception as e:
+            self.logger.error(e)
     @bot_command
     def execute(self, bot, update, args):
-        with open('shakespeare/sonnets.json', 'r') as f:
-            dat = markovify.NewlineText.from_json(f.read())
-        out = [dat.make_sentence()]
-        while out[-1][-1] not in '.!?' or len(out) < 5:
-            out.append(dat.make_sentence())
+        try:
+            out = self.pool.popleft()
+        except IndexError:
+            out = self.make_sonnet()
         bot.send_message(chat_id = update.message.chat_id,
-                         text = '\n'.join(out),
+                         text = out,
                          disable_notification = True)
-
@@ -8,25 +8,26 @@
 # command.ted:
 #   datfile: "path/to/file.txt"
 
-import os
-import requests
 import datetime
 from telegram import ParseMode
-from .basic import CommandBase, CommandInfo, CommandType, bot_command
+from .basic import CommandBase, CommandInfo, CommandType, Arg, IntArg, DailySchedule, bot_command
 
 
 class Ted(CommandBase):
     name = 'Ted'
     safename = 'ted'
+    keep_state = ('schedule',)
+    cache_ttl = 86400
 
     def __init__(self, logger):
         super().__init__(logger)
-        self.sched_chats = dict()
-        self.temp_upd = None
+        self.schedule = None
         self.to_register = [
-            CommandInfo("ted", self.execute_ted, "Displays information for a specific TED Talk."),
+            CommandInfo("ted", self.execute_ted, "Displays information for a specific TED Talk.",
+                        args=[Arg("talk")]),
             CommandInfo("tedr", self.execute_tedr, "Displays information for a random TED Talk."),
-            CommandInfo("tedadd", self.execute_add, "Schedule a daily random TED Talk."),
+            CommandInfo("tedadd", self.execute_add, "Schedule a daily random TED Talk.",
+                        args=[IntArg("hour", 0, 23)]),
             CommandInfo("teddel", self.execute_del, "Remove an existing schedule."),
             CommandInfo("ted_random", self.setup_talks, "Show scheduled daily TED Talks.", _type=CommandType.Schedule)
         ]
@@ -42,39 +43,33 @@ class Ted(CommandBase):
             return "Call /teddel to remove an existing schedule for the current chat."
 
     def load_config(self, confdict):
-        self.regfile = confdict['datfile']
-        if os.path.isfile(self.regfile):
-            with open(self.regfile, 'r') as f:
-                lines = [x.strip().split(' ') for x in f.readlines()]
-                for chat, hour in lines:
-                    self.sched_chats[int(chat)] = int(hour)
+        if self.schedule is None:
+            self.schedule = DailySchedule(confdict['datfile'], self.logger)
+
+    def checkpoint(self):
+        if self.schedule is not None:
+            self.schedule.compact()
 
     def on_exit(self):
-        if os.path.isfile(self.regfile):
-            os.remove(self.regfile)
-        if self.sched_chats:
-            with open(self.regfile, 'w') as f:
-                f.write('\n'.join(' '.join(map(str, x))
-                        for x in self.sched_chats.items()))
+        self.checkpoint()
     
     def setup_talks(self, updater):
-        self.temp_upd = updater
-        if self.sched_chats is not None:
-            for key, hour in self.sched_chats.items():
-                updater.job_queue.run_daily(
-                    self.talk_handler,
-                    time = datetime.time(hour, 0, 0),
-                    context = key
-                )
+        self.schedule.start(updater.job_queue, self.daily_talk)
+
+    def fetch_random(self):
+        data = self.http.get('https://ted.kaderobertson.pw/random').json()
+        if not data:
+            raise Exception("Couldn't get a valid TED talk.")
+        return [data]
 
-    def get_talk(self, id_or_slug, bot, chatid):
+    def get_talk(self, id_or_slug, chatid):
         data = None
         if not id_or_slug:
-            data = requests.get('https://ted.kaderobertson.pw/random').json()
+            data = self.prefetched('random', chatid, self.fetch_random, key = lambda x: x['url'])
         elif id_or_slug.isdigit():
-            data = requests.get('https://ted.kaderobertson.pw/id/' + id_or_slug).json()
+            data = self.cached(('id', id_or_slug), lambda: self.http.get('https://ted.kaderobertson.pw/id/' + id_or_slug).json())
         else:
-            data = requests.get('https://ted.kaderobertson.pw/slug/' + id_or_slug).json()
+            data = self.cached(('slug', id_or_slug), lambda: self.http.get('https://ted.kaderobertson.pw/slug/' + id_or_slug).json())
         if not data:
             raise Exception("Couldn't get a valid TED talk.")
         else:
@@ -83,57 +78,41 @@ class Ted(CommandBase):
             message = "<a href=\"{}\">{}</a>\n\n{}\n\n".format(data['url'], data['name'], data['description'])
             message += "Length: {:02d}:{:02d}\n".format(dmin, dsec)
             message += "Recorded on {} at {}.".format(datetime.datetime.utcfromtimestamp(data['recorded_date']).strftime('%Y-%m-%d'), data['event'])
-            bot.send_message(chat_id = chatid,
-                             parse_mode = ParseMode.HTML,
-                             text = message,
-                             disable_notification = True)
+            return message
+
+    def send_talk(self, bot, chatid, message):
+        return bot.send_message(chat_id = chatid,
+                                parse_mode = ParseMode.HTML,
+                                text = message,
+                                disable_notification = True)
     
-    def talk_handler(self, bot, job):
-        try:
-            if self.sched_chats is None or not job.context in self.sched_chats.keys():
-                job.schedule_removal()
-                return
-            self.get_talk(None, bot, job.context)
-            self.logger.info("ted_random schedule completed successfully.")
-        except Exception as e:
-            self.logger.error(e)
+    def daily_talk(self, bot, hour):
+        # Every chat in the same hour gets the same talk, but the talks
+        # picked for an hour don't repeat from one day to the next.
+        message = self.get_talk(None, ('daily', hour))
+        return lambda chatid: self.send_talk(bot, chatid, message)
 
     @bot_command
     def execute_ted(self, bot, update, args):
-        self.get_talk(args[0], bot, update.message.chat_id)
+        self.send_talk(bot, update.message.chat_id, self.get_talk(args[0], update.message.chat_id))
     @bot_command
     def execute_tedr(self, bot, update, args):
-        self.get_talk(None, bot, update.message.chat_id)
+        self.send_talk(bot, update.message.chat_id, self.get_talk(None, update.message.chat_id))
     @bot_command
     def execute_add(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /tedadd.",
-                             disable_notification = True)
-            return
-        if not args[0].isdigit() and 0 <= int(args[0]) <= 23:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This is not a valid hour (0 <= hour <= 23).",
-                             disable_notification = True)
-            return
-        if update.message.chat_id in self.sched_chats.keys():
+        if update.message.chat_id in self.schedule:
             bot.send_message(chat_id = update.message.chat_id,
                              text = "This chat has daily TED talks scheduled already.",
                              disable_notification = True)
             return
-        self.sched_chats[update.message.chat_id] = int(args[0])
-        self.temp_upd.job_queue.run_daily(
-            self.talk_handler,
-            time = datetime.time(int(args[0]), 0, 0),
-            context = update.message.chat_id
-        )
+        self.schedule.add(update.message.chat_id, args[0])
         bot.send_message(chat_id = update.message.chat_id,
                          text = "Daily TED talk has been scheduled.",
                          disable_notification = True)
     @bot_command
     def execute_del(self, bot, update, args):
-        if update.message.chat_id in self.sched_chats.keys():
-            del self.sched_chats[update.message.chat_id]
+        if update.message.chat_id in self.schedule:
+            self.schedule.remove(update.message.chat_id)
             bot.send_message(chat_id = update.message.chat_id,
                              text = "Daily TED talks have been disabled.",
                              disable_notification = True)
@@ -7,23 +7,38 @@
 # Configuration:
 # command.dayfact:
 #   datfile: "path/to/datfile.txt"
+#   factfile: "path/to/facts.json" (optional, defaults to datfile + ".facts")
+#   fetch_timeout: 5 (optional, seconds to spend collecting facts)
 
 import os
+import json
+import time
 import shlex
+import random
 import datetime
-import requests
-from .basic import CommandBase, CommandInfo, CommandType, bot_command
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .basic import CommandBase, CommandInfo, CommandType, IntArg, DailySchedule, atomic_write, bot_command
 
 class TodayFact(CommandBase):
     name = "TodayFact"
     safename = "todayfact"
+    keep_state = ('schedule', 'facts')
+    fetcher = ThreadPoolExecutor(max_workers = 5)
+    shown = 5
+    pool_size = 10
+    max_requests = 15
     def __init__(self, logger):
         super().__init__(logger)
-        self.sched_chats = dict()
-        self.temp_upd = None
+        self.schedule = None
+        self.facts = None
+        self.factfile = None
+        self.fetch_timeout = 5
+        self.lock = threading.Lock()
         self.to_register = [
             CommandInfo("today", self.execute, "See facts about today."),
-            CommandInfo("todayreg", self.execute_sched, "Schedule daily facts for this chat."),
+            CommandInfo("todayreg", self.execute_sched, "Schedule daily facts for this chat.",
+                        args=[IntArg("hour", 0, 23)]),
             CommandInfo("todaydel", self.execute_del, "Remove scheduled daily facts for this chat."),
             CommandInfo("fact_today", self.setup_facts, "Show scheduled daily facts", _type=CommandType.Schedule)
         ]
@@ -35,43 +50,107 @@ class TodayFact(CommandBase):
         elif cmd == "todaydel":
             return "Call /todaydel with no arguments stop receiving daily updates."
     def load_config(self, confdict):
-        self.regfile = confdict['datfile']
-        if os.path.isfile(self.regfile):
-            with open(self.regfile, 'r') as f:
-                lines = [x.strip().split(' ') for x in f.readlines()]
-                for chat, hour in lines:
-                    self.sched_chats[int(chat)] = int(hour)
+        if self.schedule is None:
+            self.schedule = DailySchedule(confdict['datfile'], self.logger)
+        self.factfile = confdict.get('factfile', confdict['datfile'] + '.facts')
+        self.fetch_timeout = float(confdict.get('fetch_timeout', 5))
+        if self.facts is None:
+            self.facts = dict()
+            self.read_facts()
+    def checkpoint(self):
+        if self.schedule is not None:
+            self.schedule.compact()
+        super().checkpoint()
     def on_exit(self):
-        if os.path.isfile(self.regfile):
-            os.remove(self.regfile)
-        if self.sched_chats:
-            with open(self.regfile, 'w') as f:
-                f.write('\n'.join(' '.join(map(str, x)) for x in self.sched_chats.items()))
-    def send_stats(self, bot, chatid):
-        today = datetime.datetime.today()
+        self.checkpoint()
+    def day_string(self, day):
         ending = 'th'
-        if today.day % 10 == 1 and today.day != 11:
+        if day.day % 10 == 1 and day.day != 11:
             ending = 'st'
-        elif today.day % 10 == 2 and today.day != 12:
+        elif day.day % 10 == 2 and day.day != 12:
             ending = 'nd'
-        elif today.day % 10 == 3 and today.day != 13:
+        elif day.day % 10 == 3 and day.day != 13:
             ending = 'rd'
-        todaystr = '{} {}{}'.format(today.strftime('%B'), today.day, ending)
+        return '{} {}{}'.format(day.strftime('%B'), day.day, ending)
+    # Adds the facts saved on disk to the ones in memory. With sharded chats
+    # the file is shared, and only the first worker warms it up.
+    def read_facts(self):
+        if not os.path.isfile(self.factfile):
+            return
+        with open(self.factfile, 'r') as f:
+            saved = json.load(f)
+        with self.lock:
+            for key, facts in saved.items():
+                self.facts[key] = list(set(self.facts.get(key, ())) | set(facts))
+    def fetch_fact(self, day):
+        tdata = self.http.get('http://numbersapi.com/{}/{}/date'.format(day.month, day.day))
+        tdata.raise_for_status()
+        return tdata.text.replace(self.day_string(day), '')
+    # Requests go out in parallel and collection stops as soon as there are
+    # enough distinct facts, after max_requests requests, or at the deadline.
+    def collect_facts(self, day, want, known=()):
+        deadline = time.monotonic() + self.fetch_timeout
+        found = set(known)
+        sent = 0
+        running = set()
+        while len(found) < want:
+            while sent < self.max_requests and len(running) < want - len(found):
+                running.add(self.fetcher.submit(self.fetch_fact, day))
+                sent += 1
+            remaining = deadline - time.monotonic()
+            if not running or remaining <= 0:
+                break
+            done, running = wait(running, timeout = remaining, return_when = FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    found.add(fut.result())
+                except Exception as e:
+                    self.logger.error(e)
+        return found
+    # Facts for a calendar day don't change, so up to pool_size of them are
+    # kept per (month, day) on disk and each message shows a random few.
+    def day_facts(self, day, want):
+        key = '{}-{}'.format(day.month, day.day)
+        with self.lock:
+            known = list(self.facts.get(key, ()))
+        if len(known) < want and self.shard.count > 1:
+            with self.shard.locked(self.factfile):
+                self.read_facts()
+            with self.lock:
+                known = list(self.facts.get(key, ()))
+        if len(known) < want:
+            found = self.collect_facts(day, want, known)
+            with self.lock:
+                known = list(set(self.facts.get(key, ())) | found)
+                self.facts[key] = known
+            self.mark_dirty()
+        return known
+    def warm_facts(self, bot, job):
+        # Runs ahead of midnight, so fetch for the day about to start too.
+        now = datetime.datetime.today()
+        for day in (now, now + datetime.timedelta(days = 1)):
+            self.day_facts(day, self.pool_size)
+        self.checkpoint()
+    def save_state(self, keys):
+        with self.shard.locked(self.factfile):
+            if self.shard.count > 1:
+                self.read_facts()
+            with self.lock:
+                data = json.dumps(self.facts)
+            atomic_write(self.factfile, data)
+    def facts_message(self):
+        today = datetime.datetime.today()
+        todaystr = self.day_string(today)
         output = "*{}*:".format(todaystr)
-        with requests.Session() as sess:
-            data = set()
-            tries = 15
-            while len(data) != 5 and tries > 0:
-                tdata = sess.get(
-                    'http://numbersapi.com/{}/{}/date'.format(today.month, today.day)
-                )
-                if tdata.status_code != 200:
-                    continue
-                data.add(tdata.text.replace(todaystr, ''))
-                tries -= 1
-            data = sorted(data, key=lambda x: int(x.split()[4]) * (-1 if x.split()[5] == "BC" else 1))
-            output += '\n' + '\n'.join(' -{}'.format(x) for x in data)
-        bot.send_message(
+        data = self.day_facts(today, self.shown)
+        data = random.sample(data, min(self.shown, len(data)))
+        if not data:
+            raise Exception("Couldn't get any facts for today.")
+        data = sorted(data, key=lambda x: int(x.split()[4]) * (-1 if x.split()[5] == "BC" else 1))
+        output += '\n' + '\n'.join(' -{}'.format(x) for x in data)
+        return output
+    def send_stats(self, bot, chatid, output):
+        return bot.send_message(
             chat_id = chatid,
             text = output,
             parse_mode = 'MARKDOWN',
@@ -79,55 +158,30 @@ class TodayFact(CommandBase):
         )
     @bot_command
     def execute(self, bot, update, args):
-        self.send_stats(bot, update.message.chat_id)
+        self.send_stats(bot, update.message.chat_id, self.facts_message())
     def setup_facts(self, updater):
-        self.temp_upd = updater
-        if self.sched_chats is not None:
-            for key, hour in self.sched_chats.items():
-                updater.job_queue.run_daily(
-                    self.execute_today,
-                    time = datetime.time(hour, 0, 0),
-                    context = key
-                )
+        self.schedule.start(updater.job_queue, self.daily_facts)
+        if self.shard.index == 0:
+            updater.job_queue.run_once(self.warm_facts, 0)
+            updater.job_queue.run_daily(self.warm_facts, time = datetime.time(23, 30, 0))
+    def daily_facts(self, bot, hour):
+        output = self.facts_message()
+        return lambda chatid: self.send_stats(bot, chatid, output)
     @bot_command
     def execute_sched(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /rss.",
-                             disable_notification = True)
-            return
-        if not args[0].isdigit() and 0 <= int(args[0]) <= 23:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This is not a valid hour (0 <= hour <= 23).",
-                             disable_notification = True)
-            return
-        if update.message.chat_id in self.sched_chats.keys():
+        if update.message.chat_id in self.schedule:
             bot.send_message(chat_id = update.message.chat_id,
                              text = "This chat has daily facts scheduled already.",
                              disable_notification = True)
             return
-        self.sched_chats[update.message.chat_id] = int(args[0])
-        self.temp_upd.job_queue.run_daily(
-            self.execute_today,
-            time = datetime.time(int(args[0]), 0, 0),
-            context = update.message.chat_id
-        )
+        self.schedule.add(update.message.chat_id, args[0])
         bot.send_message(chat_id = update.message.chat_id,
                          text = "Daily facts have been scheduled.",
                          disable_notification = True)
     @bot_command
     def execute_del(self, bot, update, args):
-        if update.message.chat_id in self.sched_chats.keys():
-            del self.sched_chats[update.message.chat_id]
+        if update.message.chat_id in self.schedule:
+            self.schedule.remove(update.message.chat_id)
             bot.send_message(chat_id = update.message.chat_id,
                              text = "Daily facts have been disabled.",
                              disable_notification = True)
-    def execute_today(self, bot, job):
-        try:
-            if self.sched_chats is None or not job.context in self.sched_chats.keys():
-                job.schedule_removal()
-                return
-            self.send_stats(bot, job.context)
-            self.logger.info("day_fact schedule completed successfully.")
-        except Exception as e:
-            self.logger.error(e)
@@ -6,7 +6,6 @@
 # Configuration: None
 
 import shlex
-import requests
 from .basic import CommandBase, CommandInfo, bot_command
 
 class UrbanDictionary(CommandBase):
@@ -20,10 +19,12 @@ class UrbanDictionary(CommandBase):
     def get_help_msg(self, cmd):
         if cmd == "udrandom":
             return "Call /udrandom with no arguments to see a random UrbanDictionary definition."
+    def fetch_random(self):
+        return self.http.get('http://api.urbandictionary.com/v0/random').json()['list']
     @bot_command
     def execute(self, bot, update, args):
-        data = requests.get('http://api.urbandictionary.com/v0/random').json()
-        choice = data['list'][0]
+        choice = self.prefetched('random', update.message.chat_id, self.fetch_random,
+                                 key = lambda x: x['defid'])
         fmt = '<b>Word:</b> <a href="{}">{}</a>\n<b>Definition:</b> {}\n<b>Example:</b> <i>{}</i>'
         defn = choice['definition']
         if len(defn) > 300:
@@ -11,7 +11,7 @@ import shlex
 import urllib
 import openweathermapy.core as owm
 from telegram import ParseMode
-from .basic import CommandBase, CommandInfo, bot_command
+from .basic import CommandBase, CommandInfo, Arg, bot_command
 
 def emojify(wid):
     # Lightning
@@ -39,11 +39,14 @@ def emojify(wid):
 
 class Weather(CommandBase):
     name = "Weather"
-    safename = "weather"   
+    safename = "weather"
+    cache_ttl = 600
+    cache_stale = 600
     def __init__(self, logger):
         super().__init__(logger)
         self.to_register = [
-            CommandInfo("weather", self.execute, "Get a location's weather.", alias="w"),
+            CommandInfo("weather", self.execute, "Get a location's weather.", alias="w",
+                        args=[Arg("location")]),
         ]
     def get_help_msg(self, cmd):
         return "Call /{} <city>,<country> where country is the 2-letter country code.".format(cmd)
@@ -63,12 +66,7 @@ class Weather(CommandBase):
     @bot_command
     def execute(self, bot, update, args):
         try:
-            if len(args) != 1:
-                bot.send_message(chat_id = update.message.chat_id,
-                                 text = "This doesn't seem like correct usage of /weather.",
-                                 disable_notification = True)
-                return
-            data = owm.get_current(args[0], **self.settings)
+            data = self.cached(args[0].lower(), lambda: owm.get_current(args[0], **self.settings))
             temp, tmin, tmax = data('main.temp', 'main.temp_min', 'main.temp_max')
             form = "<b>Weather for {}, {}:</b>\n".format(data['name'], data['sys']['country'])
             form += " - {} {}\n".format(data['weather'][0]['description'].capitalize(),
@@ -0,0 +1,129 @@
+# Webhook listener, used instead of polling when the base section has a
+# webhook url.
+#
+# Telegram POSTs each update as JSON. Updates go into a bounded queue and one
+# thread hands them to the dispatcher in arrival order. That thread waits
+# while the handler pools are too far behind, so the queue fills up and
+# further updates get a 503 with Retry-After; Telegram sends them again
+# later. On /kill and restarts the listener stops accepting updates and what
+# was already accepted is handled before the bot exits.
+#
+# Anyone who can reach the listener could post a forged update, so the bot
+# registers its url with a secret path segment added, and answers 404 to any
+# other path. The secret is the configured one, or else is derived from the
+# bot token.
+
+import hmac
+import json
+import time
+import hashlib
+import queue
+import threading
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+
+class Webhook:
+    put_timeout = 1
+    def __init__(self, bot, dispatcher, url, listen='127.0.0.1', port=8443, max_queue=1000,
+                 backlog=None, max_backlog=500, record=None, secret=None, logger=None):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        if not secret:
+            secret = hashlib.sha256(('webhook:' + bot.token).encode('utf-8')).hexdigest()[:32]
+        self.url = '{}/{}'.format(url.rstrip('/'), secret)
+        self.path = urlsplit(self.url).path
+        self.listen = listen
+        self.port = port
+        self.queue = queue.Queue(maxsize = max_queue)
+        self.backlog = backlog
+        self.max_backlog = max_backlog
+        # Line buffered, so every accepted update is on disk when it is
+        # answered.
+        self.record = open(record, 'a', buffering = 1) if record else None
+        self.record_lock = threading.Lock()
+        self.logger = logger
+        self.server = None
+        self.feeder = None
+        self.stats = dict(accepted = 0, rejected = 0, invalid = 0)
+        self.stats_lock = threading.Lock()
+    def start(self):
+        self.bot.set_webhook(url = self.url)
+        webhook = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not hmac.compare_digest(self.path.encode('utf-8'), webhook.path.encode('utf-8')):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status = webhook.accept(body)
+                self.send_response(status)
+                if status == 503:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer((self.listen, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, name = 'webhook', daemon = True).start()
+        self.feeder = threading.Thread(target = self.feed, name = 'webhook-feed', daemon = True)
+        self.feeder.start()
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+    def accept(self, body):
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.count('invalid')
+            return 400
+        try:
+            self.queue.put(data, timeout = self.put_timeout)
+        except queue.Full:
+            self.count('rejected')
+            return 503
+        self.count('accepted')
+        with self.record_lock:
+            if self.record is not None:
+                self.record.write(json.dumps(data) + '\n')
+        return 200
+    def feed(self):
+        while True:
+            self.dispatch(self.queue.get())
+    def dispatch(self, data):
+        try:
+            while self.backlog is not None and self.backlog() > self.max_backlog:
+                time.sleep(0.01)
+            self.dispatcher.process_update(Update.de_json(data, self.bot))
+        except Exception as e:
+            self.logger.error(e)
+        finally:
+            self.queue.task_done()
+    # Stops accepting updates and waits for accepted ones to be dispatched.
+    def drain(self, timeout):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.record is not None:
+            with self.record_lock:
+                self.record.close()
+                self.record = None
+        deadline = time.monotonic() + timeout
+        if threading.current_thread() is self.feeder:
+            # Admin commands run on the feed thread, so the rest of the queue
+            # is handled here, and the update calling this is still open.
+            while time.monotonic() < deadline:
+                try:
+                    data = self.queue.get_nowait()
+                except queue.Empty:
+                    return True
+                self.dispatch(data)
+            return False
+        while self.queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
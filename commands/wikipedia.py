@@ -6,17 +6,19 @@
 
 import shlex
 import wikipedia
-from .basic import CommandBase, CommandInfo, bot_command
+from .basic import CommandBase, CommandInfo, Arg, bot_command
 
 class Wikipedia(CommandBase):
     name = 'Wikipedia'
     safename = 'wikipedia'
+    cache_ttl = 3600
     def __init__(self, logger):
         super().__init__(logger)
         self.to_register = [
-            CommandInfo("wiki", self.execute_summary, "Displays a Wikipedia summary."),
-            CommandInfo("wikisearch", self.execute_search, "Searches for a Wikipedia article."),
-            CommandInfo("wikirandom", self.execute_random, "Displays a random Wikipedia summary.")
+            CommandInfo("wiki", self.execute_summary, "Displays a Wikipedia summary.", args=[Arg("page")]),
+            CommandInfo("wikisearch", self.execute_search, "Searches for a Wikipedia article.",
+                        args=[Arg("search")]),
+            CommandInfo("wikirandom", self.execute_random, "Displays a random Wikipedia summary.", args=[])
         ]
     def get_help_msg(self, cmd):
         if cmd == "wiki":
@@ -30,40 +32,27 @@ class Wikipedia(CommandBase):
             output = output.split('== ')[0].strip()
         output += '\n\n<a href="{}">view article</a>'.format(page.url)
         return output
+    def fetch_random(self):
+        return [self._getsummary(wikipedia.page(wikipedia.random(pages=1)))]
     @bot_command
     def execute_summary(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /wiki.",
-                             disable_notification = True)
-            return
-        page = wikipedia.page(args[0])
+        summary = self.cached(args[0].lower(), lambda: self._getsummary(wikipedia.page(args[0])))
         bot.send_message(chat_id = update.message.chat_id,
-                         text = self._getsummary(page),
+                         text = summary,
                          parse_mode = 'HTML',
                          disable_notification = True,
                          disable_web_page_preview = True)
     @bot_command
     def execute_random(self, bot, update, args):
-        if len(args) != 0:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /wikirandom.",
-                             disable_notification = True)
-            return
-        page = wikipedia.page(wikipedia.random(pages=1))
+        summary = self.prefetched('random', update.message.chat_id, self.fetch_random)
         bot.send_message(chat_id = update.message.chat_id,
-                         text = self._getsummary(page),
+                         text = summary,
                          parse_mode = 'HTML',
                          disable_notification = True,
                          disable_web_page_preview = True)
         
     @bot_command
     def execute_search(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /wikisearch.",
-                                disable_notification = True)
-            return
         results = wikipedia.search(args[0])
         output = "Available articles:\n" + \
                  '\n'.join(" - {}".format(res) for res in results[:7])
@@ -12,6 +12,7 @@ from .basic import CommandBase, CommandInfo, bot_command
 class Wolfram(CommandBase):
     name = "Wolfram"
     safename = "wolfram"
+    cache_ttl = 3600
     def __init__(self, logger):
         super().__init__(logger)
         self.to_register = [
@@ -23,7 +24,8 @@ class Wolfram(CommandBase):
         return "Usage: /wolfram <question>"
     @bot_command
     def execute(self, bot, update, args):
-        res = self.api.query(" ".join(args))
+        query = " ".join(args)
+        text = self.cached(query.lower(), lambda: next(self.api.query(query).results).text)
         bot.send_message(chat_id = update.message.chat_id, 
-                         text = next(res.results).text,
+                         text = text,
                          disable_notification = True)
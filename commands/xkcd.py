@@ -7,26 +7,28 @@
 # Configuration: None
 
 import shlex
-import requests
-from .basic import CommandBase, CommandInfo, bot_command
+from .basic import CommandBase, CommandInfo, Arg, bot_command
 
 class XKCD(CommandBase):
     name = "XKCD"
     safename = "xkcd"
+    cache_ttl = 604800
     def __init__(self, logger):
         super().__init__(logger)
-        self.sess = requests.Session()
         self.to_register = [
-            CommandInfo("xkcd", self.execute, "View an XKCD comic."),
+            CommandInfo("xkcd", self.execute, "View an XKCD comic.", args=[Arg("id")]),
             CommandInfo("xkcdr", self.execute_random, "View a random XKCD comic.")
         ]
-    def on_exit(self):
-        self.sess.close()
     def get_help_msg(self, cmd):
         if cmd == 'xkcd':
             return 'Call /xkcd <id> to obtain a particular comic.'
         else:
             return 'Call /xkcdr with no arguments to view a random comic.'
+    def get_comic(self, comicurl):
+        comic = self.http.get(comicurl + 'info.0.json')
+        if comic.status_code != 200:
+            raise LookupError(comicurl)
+        return comic.json()
     def send_comic(self, bot, update, comicid):
         if comicid == '404':
             bot.send_message(chat_id = update.message.chat_id,
@@ -34,22 +36,22 @@ class XKCD(CommandBase):
                              disable_notification = True)
             return
         comicurl = 'https://xkcd.com/{}/'.format(comicid)
-        comic = self.sess.get(comicurl + 'info.0.json')
-        if comic.status_code != 200:
+        try:
+            comic = self.cached(comicid, lambda: self.get_comic(comicurl))
+        except LookupError:
             bot.send_message(chat_id = update.message.chat_id,
                              text = '404: Comic Not Found',
                              disable_notification = True)
             return
-        comic = comic.json()
         msg = '<b>Link:</b> <a href="{}">{}</a>\n'.format(comicurl, comic['title'])
         msg += '<b>Date:</b> {}-{}-{}\n'.format(
             comic['year'].zfill(4), comic['month'].zfill(2), comic['day'].zfill(2)
         )
         msg += '<b>Alt Text</b>: {}'.format(comic['alt'])
-        bot.send_photo(chat_id = update.message.chat_id,
-                       photo = comic['img'],
-                       caption = '#{}: {}'.format(comic['num'], comic['title']),
-                       disable_notification = True)
+        self.send_photo(bot, chat_id = update.message.chat_id,
+                        photo = comic['img'],
+                        caption = '#{}: {}'.format(comic['num'], comic['title']),
+                        disable_notification = True)
         bot.send_message(chat_id = update.message.chat_id,
                          text = msg,
                          parse_mode = 'HTML',
@@ -57,13 +59,14 @@ class XKCD(CommandBase):
                          disable_web_page_preview = True)
     @bot_command
     def execute(self, bot, update, args):
-        if len(args) != 1:
-            bot.send_message(chat_id = update.message.chat_id,
-                             text = "This doesn't seem like correct usage of /xkcd.",
-                             disable_notification = True)
-            return
         self.send_comic(bot, update, args[0])
+    def fetch_random(self):
+        newl = self.http.get('https://c.xkcd.com/random/comic/').url
+        comicid = newl.split('.com/')[1].split('/')[0]
+        # Warm the comic cache so the reply needs no upstream request.
+        self.cached(comicid, lambda: self.get_comic('https://xkcd.com/{}/'.format(comicid)))
+        return [comicid]
     @bot_command
     def execute_random(self, bot, update, args):
-        newl = self.sess.get('https://c.xkcd.com/random/comic/').url
-        self.send_comic(bot, update, newl.split('.com/')[1].split('/')[0])
\ No newline at end of file
+        comicid = self.prefetched('random', update.message.chat_id, self.fetch_random)
+        self.send_comic(bot, update, comicid)
\ No newline at end of file
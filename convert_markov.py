@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# Converts Markov models saved as markovify JSON into the compact .markov
+# format used by the Markov plugin. The plugin converts any JSON files left in
+# its folder on startup, so this is only needed to convert ahead of time:
+#
+#   ./convert_markov.py path/to/markov/*.json
+
+import os
+import sys
+import argparse
+from commands.markovchain import convert_json
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs = "+", help = "JSON model files to convert")
+    args = parser.parse_args()
+    for src in args.files:
+        dst = os.path.splitext(src)[0] + '.markov'
+        convert_json(src, dst)
+        print("{} -> {} ({} -> {} bytes)".format(src, dst, os.path.getsize(src), os.path.getsize(dst)))
+
+if __name__ == "__main__":
+    main()
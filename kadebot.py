@@ -2,16 +2,26 @@
 
 import os
 import sys
-import shlex
+import time
+import queue
 import logging
 import argparse
-import importlib
+import threading
+import multiprocessing
 import commands as _commands
 
-from commands import CommandBase, CommandType, CommandInfo
+from commands import CommandBase, CommandType, CommandInfo, Plugin
+from commands.basic import ResponseCache, MemoryBackend, DiskBackend, FileIdCache, Checkpointer, Shard, parse_command
+from commands.metrics import metrics, TrackedUpdater
+from commands.sendqueue import SendQueue, QueuedBot
+from commands.webhook import Webhook
 from subprocess import check_output
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
 from telegram.ext import Updater
-from telegram.ext import CommandHandler, MessageHandler, Filters
+from telegram.utils.request import Request
+from telegram.ext import CommandHandler, MessageHandler, TypeHandler, Filters
 from ruamel.yaml import YAML
 
 yaml = YAML(typ="safe", pure=True)
@@ -20,9 +30,69 @@ logging.basicConfig(
     level = logging.INFO
 )
 
+config_file = None
 baseconf = dict()
 commands = []
 regdhelp = dict()
+pools = dict()
+handlers = dict()
+schedules = dict()
+core = None
+updater = None
+checkpointer = None
+outbox = None
+webhook = None
+shards = None
+started = time.perf_counter()
+
+# Runs handlers on a thread pool. Updates from different chats run in
+# parallel, updates from the same chat run one at a time in arrival order.
+class ChatPool:
+    batch = 16
+    def __init__(self, name, workers):
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = name)
+        self.lock = threading.Lock()
+        self.queues = dict()
+    def submit(self, chat_id, func, *args):
+        with self.lock:
+            if chat_id in self.queues:
+                self.queues[chat_id].append((func, args))
+                return
+            self.queues[chat_id] = deque([(func, args)])
+        self.executor.submit(self.drain, chat_id)
+    def drain(self, chat_id):
+        for _ in range(self.batch):
+            with self.lock:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                func, args = queue[0]
+            try:
+                func(*args)
+            except Exception as e:
+                logging.error(e)
+            with self.lock:
+                queue.popleft()
+        # Give other chats a turn before continuing with a busy one.
+        self.executor.submit(self.drain, chat_id)
+    def pending(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+    # Waits for queued handlers to finish, e.g. before a restart.
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+    def wrap(self, func):
+        def handler(bot, update):
+            self.submit(update.effective_chat.id, func, bot, update)
+        return handler
+    def shutdown(self):
+        self.executor.shutdown(wait = False)
 
 def version(bot, update):
     res = check_output(["git", "rev-list", "--count", "HEAD"])
@@ -34,26 +104,113 @@ def version(bot, update):
 def kill(bot, update):
     if update.message.from_user.id in baseconf["admins"]:
         logging.info("Admin killed the bot, shutting down.")
-        for cmd in commands:
-            cmd.on_exit()
+        shutdown()
         logging.info("Cleanup done, exiting.")
         sys.stdout.flush()
         os._exit(0)
 
+# Lets updates that were already accepted finish before exiting.
+def drain(timeout = 10):
+    if webhook is not None:
+        webhook.drain(timeout)
+    else:
+        # Admin commands run on the dispatcher thread, so updates polled
+        # after this one are handled here.
+        while not updater.update_queue.empty():
+            updater.dispatcher.process_update(updater.update_queue.get())
+    for pool in pools.values():
+        pool.wait(timeout)
+    outbox.drain(timeout)
+
+# Stops taking updates, lets accepted ones finish and saves plugin state.
+def shutdown():
+    drain()
+    if shards is not None:
+        shards.stop()
+        return
+    checkpointer.stop()
+    for pool in pools.values():
+        pool.shutdown()
+    # One plugin failing to save mustn't keep the others from saving, or the
+    # bot from exiting.
+    for cmd in commands:
+        try:
+            cmd.on_exit()
+        except Exception as e:
+            logging.error(e)
+    CommandBase.file_ids.save()
+
+def restart():
+    logging.info("Restarting chat bot now...")
+    shutdown()
+    python = sys.executable
+    os.execv(python, ['python3'] + sys.argv)
+
+# Files other than plugin modules can't be swapped in place.
+def core_changed():
+    for fn, mtime in core.items():
+        if not os.path.exists(fn) or os.path.getmtime(fn) != mtime:
+            return True
+    return False
+
+def reload_plugins(bot, chat_id):
+    if core_changed():
+        restart()
+    out = shards.reload() if shards is not None else reload_changed()
+    bot.send_message(chat_id = chat_id,
+                     text = '\n'.join(out) or 'No plugins changed.',
+                     disable_notification = True)
+
+def reload_changed():
+    out = []
+    for cmd in commands:
+        if not cmd.changed():
+            continue
+        try:
+            unregister(cmd)
+            cmd.reload()
+            out.append("Reloaded {}.".format(cmd.clsname))
+        except Exception as e:
+            logging.error(e)
+            out.append("Failed to reload {}: {}".format(cmd.clsname, e))
+        register(cmd)
+    return out
+
 def reload(bot, update):
     if update.message.from_user.id in baseconf["admins"]:
-        logging.info("Reloading chat bot now...")
-        for cmd in commands:
-            cmd.on_exit()
-        python = sys.executable
-        os.execv(python, ['python3'] + sys.argv)
+        if parse_command(update)[1:] == ['full']:
+            restart()
+        logging.info("Reloading changed plugins...")
+        reload_plugins(bot, update.message.chat_id)
 
 def update(bot, update):
     if update.message.from_user.id in baseconf["admins"]:
         logging.info("Updating bot...")
         os.system("git fetch origin master")
         os.system("git reset --hard origin/master")
-        reload(bot, update)
+        reload_plugins(bot, update.message.chat_id)
+
+def cachestats(bot, update):
+    if update.message.from_user.id in baseconf["admins"]:
+        out = []
+        for name, counts in sorted(CommandBase.cache.stats.items()):
+            out.append("{}: {} hit, {} stale, {} miss".format(
+                name, counts['hit'], counts['stale'], counts['miss']))
+        bot.send_message(chat_id = update.message.chat_id,
+                         text = 'Cache stats:\n' + ('\n'.join(out) or 'No lookups yet.'),
+                         disable_notification = True)
+
+def stats(bot, update):
+    if update.message.from_user.id in baseconf["admins"]:
+        out = metrics.summary()
+        out.append("send queue: {} pending, {sent} sent, {merged} merged, {retried} retried, {failed} failed".format(
+            outbox.pending(), **outbox.stats))
+        if webhook is not None:
+            out.append("webhook: {} queued, {accepted} accepted, {rejected} rejected, {invalid} invalid".format(
+                webhook.queue.qsize(), **webhook.stats))
+        bot.send_message(chat_id = update.message.chat_id,
+                         text = 'Handler stats:\n' + ('\n'.join(out) or 'No calls yet.'),
+                         disable_notification = True)
 
 def cmdlist(bot, update):
     out = []
@@ -66,7 +223,7 @@ def cmdlist(bot, update):
                      disable_notification = True)
 
 def help(bot, update):
-    args = shlex.split(update.message.text)
+    args = parse_command(update)
     if len(args) > 1:
         cmd = args[1]
         if cmd in regdhelp.keys():
@@ -88,72 +245,328 @@ def help(bot, update):
                          text = out,
                          disable_notification = True)
 
+def core_files():
+    plugins = set("{}.py".format(module) for _, module, _, _ in _commands.manifest)
+    folder = os.path.dirname(_commands.__file__)
+    out = [os.path.abspath(__file__)]
+    for fn in os.listdir(folder):
+        if fn.endswith('.py') and fn not in plugins:
+            out.append(os.path.join(folder, fn))
+    return out
+
+def startup_report():
+    out = ["Startup report:", "  {:>10} | {:>10} | plugin".format("import (s)", "state")]
+    for cmd in commands:
+        if cmd.import_time is None:
+            out.append("  {:>10} | {:>10} | {}".format("-", "deferred", cmd.clsname))
+        else:
+            out.append("  {:>10.3f} | {:>10} | {}".format(cmd.import_time, "loaded", cmd.clsname))
+    for line in out:
+        logging.info(line)
+
 def error_handler(bot, update, error):
     try:
         raise error
     except Exception as e:
         logging.error(e)
 
-def main():
-    global regdhelp
-    global commands
-    updater = Updater(token = baseconf["api_key"])
+def register(cmd):
+    dispatcher = updater.dispatcher
+    added = handlers[cmd] = []
+    for ci in cmd.to_register:
+        if ci.name in baseconf["disabled"]:
+            logging.info("Disabled command /{}".format(ci.name))
+            continue
+        if ci.name in baseconf["disabled_monitors"]:
+            logging.info("Disabled monitor {}".format(ci.name))
+            continue
+        if ci.name in baseconf["disabled_schedules"]:
+            logging.info("Disabled scheduled task {}".format(ci.name))
+            continue
+        if ci.type == CommandType.Default:
+            func = pools["commands"].wrap(metrics.track(ci.name, ci.func))
+            added.append(CommandHandler(ci.name, func))
+            regdhelp[ci.name] = cmd
+            if ci.alias != None:
+                added.append(CommandHandler(ci.alias, func))
+                regdhelp[ci.alias] = cmd
+                logging.info("Registered command /{}, /{}".format(ci.name, ci.alias))
+            else:
+                logging.info("Registered command /{}".format(ci.name))
+        elif ci.type == CommandType.Schedule:
+            # Schedules start once polling has, see main.
+            if updater.running:
+                schedule(cmd, ci)
+        else:
+            func = pools["monitors"].wrap(metrics.track(ci.name, ci.func))
+            added.append(MessageHandler(ci.filter, func))
+            logging.info("Registered monitor {}".format(ci.name))
+    for handler in added:
+        dispatcher.add_handler(handler)
+
+def unregister(cmd):
+    for handler in handlers.pop(cmd, []):
+        updater.dispatcher.remove_handler(handler)
+    for upd in schedules.pop(cmd, []):
+        for job in upd.job_queue.jobs:
+            job.schedule_removal()
+
+def schedule(cmd, ci):
+    upd = TrackedUpdater(updater, ci.name, metrics)
+    schedules.setdefault(cmd, []).append(upd)
+    ci.func(upd)
+    logging.info("Registered scheduled task {}".format(ci.name))
+
+# Sharded mode. The front process receives updates and passes each one over
+# a pipe to the worker process that owns its chat (chat id modulo the number
+# of workers). Workers run the plugins for their own chats only. /kill,
+# /reload and /update are handled by the front and carried out by every
+# worker. A worker that dies is started again, after a growing delay if it
+# keeps exiting soon after starting, and not at all after max_quick_exits.
+class Shards:
+    quick_exit = 30
+    max_quick_exits = 5
+    def __init__(self, filename, count):
+        self.filename = filename
+        self.count = count
+        self.context = multiprocessing.get_context('spawn')
+        self.procs = [None] * count
+        self.conns = [None] * count
+        self.locks = [threading.Lock() for _ in range(count)]
+        self.replies = [queue.Queue() for _ in range(count)]
+        self.started = [0] * count
+        self.quick_exits = [0] * count
+        self.seq = 0
+        self.stopping = False
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+    def spawn(self, index):
+        conn, child = self.context.Pipe()
+        proc = self.context.Process(target = shard_main, args = (self.filename, index, self.count, child),
+                                    name = "shard{}".format(index))
+        proc.start()
+        child.close()
+        self.started[index] = time.monotonic()
+        with self.locks[index]:
+            self.procs[index] = proc
+            self.conns[index] = conn
+        threading.Thread(target = self.listen, args = (index, conn), daemon = True).start()
+    def listen(self, index, conn):
+        while True:
+            try:
+                self.replies[index].put(conn.recv())
+            except (EOFError, OSError):
+                break
+        self.procs[index].join()
+        if self.stopping:
+            return
+        if time.monotonic() - self.started[index] < self.quick_exit:
+            self.quick_exits[index] += 1
+        else:
+            self.quick_exits[index] = 0
+        if self.quick_exits[index] >= self.max_quick_exits:
+            logging.error("Shard {} exited with code {} right after starting {} times, not restarting it.".format(
+                index, self.procs[index].exitcode, self.quick_exits[index]))
+            return
+        delay = 2 ** self.quick_exits[index] - 1
+        logging.error("Shard {} exited with code {}, restarting it in {}s.".format(
+            index, self.procs[index].exitcode, delay))
+        time.sleep(delay)
+        if not self.stopping:
+            self.spawn(index)
+    def send(self, index, msg):
+        # Blocks while the worker's pipe is full, which holds back polling.
+        with self.locks[index]:
+            self.conns[index].send(msg)
+    def route(self, bot, update):
+        chat = update.effective_chat
+        index = chat.id % self.count if chat is not None else 0
+        try:
+            self.send(index, ('update', update.to_dict()))
+        except OSError as e:
+            logging.error("Couldn't pass an update to shard {}: {}".format(index, e))
+    # Requests carry an id that the worker sends back, so a late answer to
+    # an earlier request isn't taken for this one.
+    def ask(self, op, timeout):
+        self.seq += 1
+        ident = self.seq
+        for index in range(self.count):
+            try:
+                self.send(index, (op, ident))
+            except OSError as e:
+                logging.error("Couldn't reach shard {}: {}".format(index, e))
+        deadline = time.monotonic() + timeout
+        out = []
+        for index in range(self.count):
+            answer = None
+            while True:
+                try:
+                    reply = self.replies[index].get(timeout = max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if reply[0] == ident:
+                    answer = reply[1]
+                    break
+            out.append(answer)
+        return out
+    def reload(self):
+        out = []
+        for index, lines in enumerate(self.ask('reload', 60)):
+            if lines is None:
+                out.append("Shard {} didn't answer.".format(index))
+            for line in lines or ():
+                if line not in out:
+                    out.append(line)
+        return out
+    def stop(self, timeout = 30):
+        self.stopping = True
+        self.ask('stop', timeout)
+        for proc in self.procs:
+            proc.join(timeout)
+
+def shard_main(filename, index, count, conn):
+    global updater
+    CommandBase.shard = Shard(index, count)
+    load_config(filename)
+    sendconf = dict(baseconf.get("send_queue", dict()))
+    # Workers send to different chats, so they split the overall limit.
+    sendconf["global_rate"] = sendconf.get("global_rate", 30) / count
+    updater = make_updater(sendconf)
+    port = baseconf.get("metrics_port")
+    start_plugins(admin = False, metrics_port = port + index if port else None)
+    updater.running = True
+    updater.job_queue.start()
+    start_schedules()
+    logging.info("Shard {} of {} started {:.3f}s after launch.".format(index + 1, count, time.perf_counter() - started))
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            # The front process is gone.
+            msg = ('stop', None)
+        if msg[0] == 'update':
+            try:
+                updater.dispatcher.process_update(Update.de_json(msg[1], updater.bot))
+            except Exception as e:
+                logging.error(e)
+        elif msg[0] == 'reload':
+            conn.send((msg[1], reload_changed()))
+        elif msg[0] == 'stop':
+            shutdown()
+            try:
+                conn.send((msg[1], 'stopped'))
+            except OSError:
+                pass
+            sys.stdout.flush()
+            os._exit(0)
+
+def make_updater(sendconf):
+    global outbox
+    outbox = SendQueue(logger = logging, **sendconf)
+    # Sends run on the queue's own workers, so give them their own connections.
+    bot = QueuedBot(baseconf["api_key"], outbox, base_url = baseconf.get("base_url"),
+                    request = Request(con_pool_size = outbox.workers + 8))
+    return Updater(bot = bot)
+
+def start_plugins(admin = True, metrics_port = None):
+    global checkpointer
     dispatcher = updater.dispatcher
+    workers = baseconf.get("workers", dict())
+    pools["commands"] = ChatPool("commands", workers.get("commands", 8))
+    pools["monitors"] = ChatPool("monitors", workers.get("monitors", 2))
     dispatcher.add_handler(CommandHandler("help", help))
     dispatcher.add_handler(CommandHandler("list", cmdlist))
-    dispatcher.add_handler(CommandHandler("reload", reload))
-    dispatcher.add_handler(CommandHandler("update", update))
-    dispatcher.add_handler(CommandHandler("kill", kill))
+    if admin:
+        dispatcher.add_handler(CommandHandler("reload", reload))
+        dispatcher.add_handler(CommandHandler("update", update))
+        dispatcher.add_handler(CommandHandler("kill", kill))
     dispatcher.add_handler(CommandHandler("version", version))
-    to_schedule = []
+    dispatcher.add_handler(CommandHandler("cachestats", cachestats))
+    dispatcher.add_handler(CommandHandler("stats", stats))
     for cmd in commands:
-        for ci in cmd.to_register:
-            if ci.name in baseconf["disabled"]:
-                logging.info("Disabled command /{}".format(ci.name))
-                continue
-            if ci.name in baseconf["disabled_monitors"]:
-                logging.info("Disabled monitor {}".format(ci.name))
-                continue
-            if ci.name in baseconf["disabled_schedules"]:
-                logging.info("Disabled scheduled task {}".format(ci.name))
-                continue
-            if ci.type == CommandType.Default:
-                dispatcher.add_handler(CommandHandler(ci.name, ci.func))
-                regdhelp[ci.name] = cmd
-                if ci.alias != None:
-                    dispatcher.add_handler(CommandHandler(ci.alias, ci.func))
-                    regdhelp[ci.alias] = cmd
-                    logging.info("Registered command /{}, /{}".format(ci.name, ci.alias))
-                else:
-                    logging.info("Registered command /{}".format(ci.name))
-            elif ci.type == CommandType.Schedule:
-                to_schedule.append(ci)
-            else:
-                dispatcher.add_handler(MessageHandler(ci.filter, ci.func))
-                logging.info("Registered monitor {}".format(ci.name))
+        register(cmd)
     dispatcher.add_error_handler(error_handler)
-    updater.start_polling()
-    logging.info("Started polling for commands.")
-    if len(to_schedule) > 0:
-        logging.info("Registering scheduled tasks..")
-    for ci in to_schedule:
-        ci.func(updater)
-        logging.info("Registered scheduled task {}".format(ci.name))
+    targets = [cmd.checkpoint for cmd in commands] + [CommandBase.file_ids.save]
+    checkpointer = Checkpointer(targets, baseconf.get("checkpoint_interval", 300), logging)
+    checkpointer.start()
+    if metrics_port:
+        metrics.serve(metrics_port)
+        logging.info("Serving metrics on port {}.".format(metrics_port))
+
+def start_updates():
+    global webhook
+    hookconf = baseconf.get("webhook", dict())
+    if hookconf.get("url"):
+        backlog = lambda: sum(pool.pending() for pool in pools.values())
+        webhook = Webhook(updater.bot, updater.dispatcher, backlog = backlog, logger = logging, **hookconf)
+        updater.running = True
+        updater.job_queue.start()
+        webhook.start()
+        logging.info("Listening for updates on {}:{} {:.3f}s after launch.".format(
+            webhook.listen, webhook.port, time.perf_counter() - started))
+    else:
+        updater.start_polling()
+        logging.info("Started polling for commands {:.3f}s after launch.".format(time.perf_counter() - started))
+
+def start_schedules():
+    logging.info("Registering scheduled tasks..")
+    for cmd in commands:
+        for ci in cmd.to_register:
+            if ci.type == CommandType.Schedule and not ci.name in baseconf["disabled_schedules"]:
+                schedule(cmd, ci)
+
+def main(report = False):
+    global updater
+    global core
+    global shards
+    updater = make_updater(baseconf.get("send_queue", dict()))
+    count = baseconf.get("shards", 1)
+    if count > 1:
+        shards = Shards(config_file, count)
+        shards.start()
+        dispatcher = updater.dispatcher
+        dispatcher.add_handler(CommandHandler("reload", reload))
+        dispatcher.add_handler(CommandHandler("update", update))
+        dispatcher.add_handler(CommandHandler("kill", kill))
+        dispatcher.add_handler(TypeHandler(Update, shards.route))
+        dispatcher.add_error_handler(error_handler)
+        start_updates()
+        core = dict((fn, os.path.getmtime(fn)) for fn in core_files())
+        logging.info("Passing updates to {} shards.".format(count))
+        return
+    start_plugins(metrics_port = baseconf.get("metrics_port"))
+    start_updates()
+    core = dict((fn, os.path.getmtime(fn)) for fn in core_files())
+    start_schedules()
+    if report:
+        startup_report()
 
 def load_config(filename):
+    global config_file
     global baseconf
     global commands
+    config_file = filename
     conf = dict()
     with open(filename, 'r') as f:
         conf = yaml.load(f)
     baseconf = conf["base"]
+    CommandBase.http.configure(**baseconf.get("http", dict()))
+    cacheconf = baseconf.get("cache", dict())
+    if cacheconf.get("backend") == "disk":
+        CommandBase.cache = ResponseCache(DiskBackend(cacheconf["folder"], cacheconf.get("max_entries", 4096)))
+    else:
+        CommandBase.cache = ResponseCache(MemoryBackend(cacheconf.get("max_entries", 512)))
+    fileidconf = baseconf.get("file_id_cache", dict())
+    CommandBase.file_ids = FileIdCache(CommandBase.shard.path(fileidconf.get("path")), fileidconf.get("max_entries", 2048))
     logging.info("Loaded base configuration.")
-    for command in _commands.__all__:
-        if 'Command' not in command and command not in baseconf['disabled_modules']:
-            mod = importlib.import_module('commands')
-            commands.append(getattr(mod, command)(logging))
-        elif command in baseconf['disabled_modules']:
-            logging.info("Disabled module {}.".format(command))
+    # Plugins are registered from the manifest and only imported when one of
+    # their commands is first used or one of their schedules is set up.
+    for clsname, module, safename, entries in _commands.manifest:
+        if clsname in baseconf['disabled_modules']:
+            logging.info("Disabled module {}.".format(clsname))
+            continue
+        commands.append(Plugin(clsname, module, safename, entries, logging))
     for cmd in commands:
         section = "command.{}".format(cmd.safename)
         if section in conf.keys():
@@ -168,9 +581,14 @@ if __name__ == "__main__":
         help = "configuration file to use",
         type = str
     )
+    parser.add_argument(
+        "--startup-report",
+        action = "store_true",
+        help = "log per-plugin import times once the bot is running"
+    )
     args = parser.parse_args()
     if os.path.exists(args.config):
         load_config(args.config)
-        main()
+        main(args.startup_report)
     else:
         logging.error("No config file found.")
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Stands in for Telegram and POSTs updates to a bot running in webhook mode,
+# to see how many updates a second it keeps up with. Updates come from a file
+# of one JSON update per line, like the one written by the webhook `record`
+# option, or are made up. The url ends with the webhook `secret`:
+#
+#   ./replay_updates.py http://127.0.0.1:8443/hook/SECRET --file updates.jsonl --rate 500
+#   ./replay_updates.py http://127.0.0.1:8443/hook/SECRET --synthetic 10000 --text "/8ball"
+
+import sys
+import json
+import time
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+def synthetic(count, chats, text):
+    entities = []
+    if text.startswith('/'):
+        entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+    for n in range(count):
+        chat_id = -1000000 - n % chats
+        yield {'update_id': n + 1, 'message': {
+            'message_id': n + 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'replay'},
+            'from': {'id': n % 1000 + 1, 'is_bot': False, 'first_name': 'replay'},
+            'text': text,
+            'entities': entities
+        }}
+
+def recorded(path):
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help = "webhook url the bot listens on, including the secret")
+    parser.add_argument("--file", help = "updates to replay, one JSON update per line")
+    parser.add_argument("--synthetic", type = int, default = 1000, help = "number of made-up updates to send without --file")
+    parser.add_argument("--chats", type = int, default = 50, help = "chats to spread made-up updates over")
+    parser.add_argument("--text", default = "hello there.", help = "text of made-up updates")
+    parser.add_argument("--rate", type = float, default = 0, help = "updates per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type = int, default = 16, help = "requests in flight at once")
+    args = parser.parse_args()
+    updates = list(recorded(args.file) if args.file else synthetic(args.synthetic, args.chats, args.text))
+    local = threading.local()
+    lock = threading.Lock()
+    statuses = dict()
+    latencies = []
+    def post(update):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = session.post(args.url, json = update, timeout = 10).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = args.concurrency) as pool:
+        for n, update in enumerate(updates):
+            if args.rate:
+                delay = start + n / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(post, update)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("sent {} updates in {:.2f}s ({:.0f}/s)".format(len(updates), elapsed, len(updates) / elapsed))
+    print("responses: " + ', '.join('{} x{}'.format(k, v) for k, v in sorted(statuses.items(), key = str)))
+    if latencies:
+        print("response time p50 {:.1f}ms, p99 {:.1f}ms".format(
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+    return 0 if set(statuses) == {200} else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
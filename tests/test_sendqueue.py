@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import unittest
+from telegram.error import BadRequest, Unauthorized, ChatMigrated, NetworkError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from commands.sendqueue import SendQueue
+
+class Sender:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+    def __call__(self, url, data, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return data['text']
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = SendQueue(global_rate = 1000, private_rate = 1000, private_burst = 1000)
+    def submit(self, send, chat_id = 1):
+        return self.queue.submit(chat_id, send, '/sendMessage', dict(chat_id = chat_id, text = 'hi'), dict())
+    def test_permanent_errors_are_not_retried(self):
+        for error in (BadRequest("Message is too long"), Unauthorized("Forbidden"), ChatMigrated(2)):
+            send = Sender([error])
+            start = time.monotonic()
+            with self.assertRaises(type(error)):
+                self.submit(send).result(timeout = 5)
+            self.assertEqual(send.calls, 1)
+            self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.queue.stats['retried'], 0)
+        self.assertEqual(self.queue.stats['failed'], 3)
+    def test_chat_is_not_blocked_after_permanent_error(self):
+        self.submit(Sender([BadRequest("Chat not found")]))
+        self.assertEqual(self.submit(Sender([])).result(timeout = 5), 'hi')
+    def test_network_errors_are_retried(self):
+        send = Sender([NetworkError("Connection reset")])
+        self.assertEqual(self.submit(send).result(timeout = 10), 'hi')
+        self.assertEqual(send.calls, 2)
+        self.assertEqual(self.queue.stats['retried'], 1)
+
+if __name__ == "__main__":
+    unittest.main()